@@ -1,5 +1,6 @@
 from cordex.pipeline.core import Pipeline
 from cordex.pipeline.resources import download
+from cordex.representations.lookup import load_lookup_lexicon
 
 import logging
 logger = logging.getLogger('cordex')
\ No newline at end of file
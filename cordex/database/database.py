@@ -4,33 +4,177 @@ Tools for handling memory/actual database.
 import sqlite3
 import os
 
+from cordex.database.string_store import StringStore
+from cordex.utils.progress_bar import progress
+
+# database performance profiles (sqlite pragmas and loading settings)
+DB_PROFILES = {
+    # sqlite defaults, changes are committed after every file
+    'safe': {
+        'bulk_load': False,
+        'commit_files': 1,
+    },
+    # faster writes that survive application crashes, but may lose latest commits on power loss
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -256000,
+        'mmap_size': 2 ** 30,
+        'temp_store': 'MEMORY',
+        'bulk_load': False,
+        'commit_files': 1,
+    },
+    # fastest loading, database file may be corrupted if processing is interrupted
+    'bulk': {
+        'journal_mode': 'OFF',
+        'synchronous': 'OFF',
+        'cache_size': -1024000,
+        'mmap_size': 2 ** 31,
+        'temp_store': 'MEMORY',
+        'bulk_load': True,
+        'commit_files': 100,
+    },
+}
+PRAGMAS = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store']
+# allowed values of pragmas, either lists of names and numbers or type of value
+PRAGMA_VALUES = {
+    'journal_mode': ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'],
+    'synchronous': ['OFF', 'NORMAL', 'FULL', 'EXTRA', 0, 1, 2, 3],
+    'cache_size': int,
+    'mmap_size': int,
+    'temp_store': ['DEFAULT', 'FILE', 'MEMORY', 0, 1, 2],
+}
+# pragmas that are set separately for every attached database
+SCHEMA_PRAGMAS = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size']
+# version of tables (stored as `user_version` of database files), it changes whenever stored data changes
+SCHEMA_VERSION = 1
+
+
+def database_profile(args):
+    """ Returns settings of database profile `db_profile`, overridden by `db_pragmas`. Settings are validated, as
+    pragmas are added to sqlite statements. """
+    if args['db_profile'] not in DB_PROFILES:
+        raise ValueError(f'Unknown db_profile: {args["db_profile"]} (it should be one of '
+                         f'{", ".join(DB_PROFILES)}).')
+    profile = {**DB_PROFILES[args['db_profile']], **(args['db_pragmas'] or {})}
+
+    for name, value in profile.items():
+        if name == 'bulk_load':
+            valid = type(value) == bool
+        elif name == 'commit_files':
+            valid = type(value) == int and value > 0
+        elif name not in PRAGMA_VALUES:
+            raise ValueError(f'Unknown setting in db_pragmas: {name} (it should be one of '
+                             f'{", ".join(PRAGMAS)}, bulk_load or commit_files).')
+        elif PRAGMA_VALUES[name] == int:
+            valid = type(value) == int
+        else:
+            valid = (value.upper() if type(value) == str else value) in PRAGMA_VALUES[name] and type(value) != bool
+        if not valid:
+            raise ValueError(f'Invalid value of {name} in db_pragmas: {value!r}.')
+    return profile
+
 
 class Database:
     def __init__(self, args):
+        profile = database_profile(args)
         filename = ":memory:" if args['db'] is None else args['db']
+        self.overwrite = args['overwrite_db']
 
-        if args['overwrite_db'] and os.path.exists(filename):
+        if self.overwrite and os.path.exists(filename):
             os.remove(filename)
 
         self.new = not os.path.exists(filename)
         self.db = sqlite3.connect(filename)
+        self.check_version(filename, 'main', self.new)
+
+        self.profile = profile
+        for pragma in PRAGMAS:
+            if pragma in profile:
+                self.db.execute(f"PRAGMA {pragma}={profile[pragma]}")
+
+        # in bulk load mode indexes that are not needed while loading files are created after loading, which is
+        # always the case for databases in memory, as they are lost on interruption anyway
+        self.bulk_load = profile['bulk_load'] or args['db'] is None
+        self.deferred_indexes = []
+        self.commit_files = profile['commit_files']
+        self.uncommitted_files = 0
 
         self.init("CREATE TABLE StepsDone ( step varchar(32) )")
+        self.strings = StringStore(self)
         self.commit()
     
+    def attach(self, filename, schema):
+        """ Attaches another database file (or in-memory database when `filename` is None) under name `schema` with
+        the same pragmas. Returns whether attached database is new. """
+        if filename is None:
+            filename, new = ":memory:", True
+        else:
+            if self.overwrite and os.path.exists(filename):
+                os.remove(filename)
+            new = not os.path.exists(filename)
+
+        self.db.execute(f"ATTACH DATABASE ? AS {schema}", (filename,))
+        self.check_version(filename, schema, new)
+        for pragma in SCHEMA_PRAGMAS:
+            if pragma in self.profile:
+                self.db.execute(f"PRAGMA {schema}.{pragma}={self.profile[pragma]}")
+        return new
+
+    def check_version(self, filename, schema, new):
+        """ Marks new database file `schema` with the current version of tables, or checks that existing one has
+        it, as files from other versions of cordex can not be read. """
+        if new:
+            self.db.execute(f"PRAGMA {schema}.user_version={SCHEMA_VERSION}")
+            return
+
+        version = self.db.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.close()
+            raise ValueError(f'Database {filename} was created by {"an older" if version < SCHEMA_VERSION else "a newer"}'
+                             f' version of cordex, process corpus again with `overwrite_db=True`.')
+
     def execute(self, *args, **kwargs):
         """ Executes database command.  """
         return self.db.execute(*args, **kwargs)
 
+    def executemany(self, *args, **kwargs):
+        """ Executes database command for every set of parameters. """
+        return self.db.executemany(*args, **kwargs)
+
     def init(self, *args, **kwargs):
         """ Same as execute, only skipped if not a new database file. """
         if self.new:
             return self.execute(*args, **kwargs)
+
+    def init_index(self, name, table, columns, unique=False, deferred=False):
+        """ Creates index if it does not exist yet. Creation of deferred indexes is postponed until
+        `create_deferred_indexes` in bulk load mode. """
+        statement = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+        if deferred and self.bulk_load:
+            self.deferred_indexes.append(statement)
+        else:
+            self.execute(statement)
+
+    def create_deferred_indexes(self):
+        """ Creates indexes, whose creation was deferred. """
+        for statement in progress(self.deferred_indexes, "creating-indexes"):
+            self.execute(statement)
+        self.deferred_indexes = []
+        self.commit()
     
     def commit(self):
         """ Commits changes. """
+        self.strings.flush()
         self.db.commit()
 
+    def file_loaded(self):
+        """ Commits changes after every `commit_files` loaded files. """
+        self.uncommitted_files += 1
+        if self.uncommitted_files >= self.commit_files:
+            self.commit()
+            self.uncommitted_files = 0
+
     def is_step_done(self, step_name):
         """ Checks whether step results are in database. """
         wc_done = self.db.execute("SELECT count(*) FROM StepsDone WHERE step=?", (step_name, )).fetchone()
@@ -39,5 +183,4 @@ class Database:
     def step_is_done(self, step_name):
         """ Completes and stores step. """
         self.db.execute("INSERT INTO StepsDone (step) VALUES (?)", (step_name, ))
-        self.db.commit()
-
+        self.commit()
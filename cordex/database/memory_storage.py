@@ -0,0 +1,209 @@
+"""
+Storage in memory, without sqlite.
+"""
+from collections import defaultdict
+
+from cordex.database.storage import Storage
+from cordex.words.compact import StringTable
+
+
+class MemoryStorage(Storage):
+    """ Stores results in dictionaries and lists. It avoids the overhead of sqlite on small and medium corpora, but
+    results are lost when processing ends, so it cannot be combined with `db`. """
+    def __init__(self, args):
+        super().__init__()
+        if args['db'] is not None:
+            raise ValueError('Memory storage does not support `db`, use `storage="sqlite"` instead.')
+
+        self.strings = StringTable()
+        self.is_ud = args['is_ud']
+        self.files = set()
+        self.steps = set()
+
+        # collocations and matches
+        self.collocation_info = {}
+        self.collocation_components = {}
+        self.structure_collocations = defaultdict(list)
+        self.collocation_matches = defaultdict(list)
+        self.matches = defaultdict(list)
+        self.representations = defaultdict(list)
+        self.dispersions = []
+
+        # words are lists of [lemma, msd, upos, text, frequency], uw_id of a word is its index + 1
+        self.word_list = []
+        self.word_ids = defaultdict(list)
+        self.lemma_word_ids = defaultdict(list)
+        self.num_words = []
+        self.word_counts = defaultdict(dict)
+
+    def is_file_loaded(self, fname):
+        """ Checks whether file is already stored. """
+        return fname in self.files
+
+    def file_loaded(self, fname):
+        """ Marks file as stored. """
+        self.files.add(fname)
+
+    def commit(self):
+        """ Results are not persisted, so there is nothing to commit. """
+
+    def loading_done(self):
+        """ Memory storage needs no preparation for queries. """
+
+    def is_step_done(self, step_name):
+        """ Checks whether step is done. """
+        return step_name in self.steps
+
+    def step_is_done(self, step_name):
+        """ Completes step. """
+        self.steps.add(step_name)
+
+    def collocation_keys(self):
+        """ Lists (collocation_id, structure_id, key) of all collocations. """
+        return ((cid, structure_id, key) for cid, (structure_id, key) in self.collocation_info.items())
+
+    def max_match_id(self):
+        """ Returns the biggest match id or None when there are no matches. """
+        return max(self.matches, default=None)
+
+    def add_matches(self, collocations, components, matches, collocation_matches):
+        """ Adds collocations, their components, matches and links between them. """
+        for cid, structure_id, key in collocations:
+            self.collocation_info[cid] = (structure_id, key)
+            self.collocation_components[cid] = []
+            self.structure_collocations[structure_id].append(cid)
+        for cid, component_id, lemma in components:
+            self.collocation_components[cid].append((component_id, lemma))
+        for match_id, *word in matches:
+            self.matches[match_id].append(tuple(word))
+        for cid, match_id in collocation_matches:
+            self.collocation_matches[cid].append(match_id)
+
+    def num_collocations(self):
+        """ Counts collocations. """
+        return len(self.collocation_info)
+
+    def collocations(self):
+        """ Lists (collocation_id, structure_id) of all collocations in order of ids. """
+        return ((cid, structure_id) for cid, (structure_id, _key) in sorted(self.collocation_info.items()))
+
+    def collocation_ids(self, structure_id, collocation_id):
+        """ Lists ids of all collocations (or only of given structure or collocation) in order. """
+        if collocation_id is not None:
+            return [collocation_id] if collocation_id in self.collocation_info else []
+        if structure_id is not None:
+            return sorted(self.structure_collocations.get(structure_id, []))
+        return sorted(self.collocation_info)
+
+    def match_rows(self, structure_id=None, collocation_id=None):
+        """ Lists matched words in order of collocation ids, match ids and insertion. """
+        for cid in self.collocation_ids(structure_id, collocation_id):
+            sid = self.collocation_info[cid][0]
+            for match_id in sorted(self.collocation_matches[cid]):
+                for component_id, lemma, text, msd, word_id, sentence_id in self.matches[match_id]:
+                    yield cid, sid, match_id, component_id, lemma, text, msd, word_id, sentence_id
+
+    def representation_rows(self, structure_id=None, collocation_id=None):
+        """ Lists representations in order of collocation ids and insertion. """
+        for cid in self.collocation_ids(structure_id, collocation_id):
+            for component_id, text, msd in self.representations.get(cid, []):
+                yield cid, component_id, text, msd
+
+    def add_representations(self, representations):
+        """ Adds representations. """
+        for cid, component_id, text, msd in representations:
+            self.representations[cid].append((component_id, text, msd))
+
+    def collocation_dispersions(self, min_freq):
+        """ Counts collocations with at least `min_freq` matches per (structure_id, component_id, lemma). """
+        dispersions = defaultdict(int)
+        for cid, (structure_id, _key) in self.collocation_info.items():
+            if len(self.collocation_matches[cid]) < min_freq:
+                continue
+            for component_id, lemma in self.collocation_components[cid]:
+                dispersions[(structure_id, component_id, lemma)] += 1
+        return ((structure_id, component_id, lemma, dispersion)
+                for (structure_id, component_id, lemma), dispersion in dispersions.items())
+
+    def store_dispersions(self, dispersions):
+        """ Stores dispersions. """
+        self.dispersions = list(dispersions)
+
+    def load_dispersions(self):
+        """ Lists stored dispersions. """
+        return iter(self.dispersions)
+
+    def add_word_counts(self, counts, num_words):
+        """ Adds frequencies of words to all words with the same (lemma, msd, text) or appends a new word. """
+        for (lemma, msd, text), (freq, upos) in counts:
+            uw_ids = self.word_ids[(lemma, msd, text)]
+            if not uw_ids:
+                self.word_list.append([lemma, msd, upos, text, 0])
+                uw_ids.append(len(self.word_list))
+                self.lemma_word_ids[lemma].append(len(self.word_list))
+            for uw_id in uw_ids:
+                self.word_list[uw_id - 1][4] += freq
+
+        self.num_words.append(num_words)
+
+    def words(self):
+        """ Lists words (uw_id, lemma, msd, text, frequency) in order of ids. """
+        return ((uw_id, lemma, msd, text, freq)
+                for uw_id, (lemma, msd, _upos, text, freq) in enumerate(self.word_list, start=1))
+
+    def update_word_texts(self, updates):
+        """ Changes texts of words. """
+        for text, uw_id in updates:
+            word = self.word_list[uw_id - 1]
+            self.word_ids[(word[0], word[1], word[3])].remove(uw_id)
+            word[3] = text
+            self.word_ids[(word[0], word[1], text)].append(uw_id)
+
+    def num_all_words(self):
+        """ Counts all words. """
+        return sum(self.num_words)
+
+    def generate_word_counts(self):
+        """ Sums frequencies of words per lemma and upos (or the first letter of xpos). """
+        strings = self.strings
+        word_counts = defaultdict(dict)
+        for lemma, msd, upos, _text, freq in self.word_list:
+            msd0 = strings[upos] if self.is_ud else strings[msd][:1]
+            counts = word_counts[lemma]
+            counts[msd0] = counts.get(msd0, 0) + freq
+        self.word_counts = word_counts
+
+    def num_word_rows(self):
+        """ Returns the number of words and word counts and the number of distinct lemmas. """
+        return (len(self.word_list) + sum(len(counts) for counts in self.word_counts.values()),
+                len(self.lemma_word_ids))
+
+    def all_words(self):
+        """ Lists all words ordered by lemma, descending frequency and id. """
+        for lemma in sorted(self.lemma_word_ids):
+            for msd, text, freq in self.lemma_words(lemma):
+                yield lemma, msd, text, freq
+
+    def all_word_counts(self):
+        """ Lists all word counts. """
+        return ((lemma, msd0, freq) for lemma, counts in self.word_counts.items() for msd0, freq in counts.items())
+
+    def lemma_words(self, lemma):
+        """ Lists words of lemma ordered by descending frequency and id. """
+        words = []
+        for uw_id in self.lemma_word_ids.get(lemma, []):
+            _lemma, msd, _upos, text, freq = self.word_list[uw_id - 1]
+            words.append((-freq, uw_id, msd, text))
+        return [(msd, text, -neg_freq) for neg_freq, _uw_id, msd, text in sorted(words)]
+
+    def lemma_word_counts(self, lemma):
+        """ Lists word counts of lemma. """
+        return list(self.word_counts.get(lemma, {}).items())
+
+    def word_texts(self, lemma, msd):
+        """ Lists texts and frequencies of words with lemma and msd. """
+        return [(text, freq) for uw_msd, text, freq in self.lemma_words(lemma) if uw_msd == msd]
+
+    def word_count(self, lemma, msd0):
+        """ Returns word count of lemma and msd0. """
+        return self.word_counts[lemma][msd0]
@@ -0,0 +1,135 @@
+"""
+Storage in sqlite database, whose collocations and matches are split into several database files.
+"""
+import heapq
+import os
+import sqlite3
+import zlib
+
+from cordex.database.sqlite_storage import SQLiteStorage
+
+
+class ShardedStorage(SQLiteStorage):
+    """
+    Stores collocations, matches and representations of every structure in one of `shards` database files, that are
+    attached to the main database `db` (which holds everything else). Shard files are named after `db`, e.g.
+    `cordex.shard0.db` for `cordex.db`. Every shard is a smaller database with smaller indexes, and work on a single
+    structure only touches its shard. Commits are atomic across all files only with rollback journal (not in WAL mode
+    or without journal), so after an interruption shards may not agree with loaded files in the main database.
+    """
+    def __init__(self, args):
+        self.num_shards = args['shards']
+        self.db_path = args['db']
+        self.collocation_shards = {}
+        super().__init__(args)
+
+        # shards of existing collocations are needed for adding their matches and representations
+        for collocation_id, structure_id, _key in self.collocation_keys():
+            self.collocation_shards[collocation_id] = self.structure_shard(structure_id)
+
+    def init_match_tables(self):
+        """ Attaches shards and creates tables of collocations, matches and representations in them. """
+        # `getlimit` is only available since python 3.11, 10 is the default limit of sqlite
+        getlimit = getattr(self.db.db, 'getlimit', None)
+        max_shards = getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if getlimit is not None else 10
+        if not 1 <= self.num_shards <= max_shards:
+            raise ValueError(f'Number of shards should be between 1 and {max_shards}.')
+
+        for shard in range(self.num_shards):
+            if self.db.attach(self.shard_path(shard), f"shard{shard}"):
+                self.create_match_tables(f"shard{shard}.", self.db.execute)
+            elif self.db.new:
+                raise ValueError(f'Shard {self.shard_path(shard)} exists without its database, remove it or use '
+                                 f'`overwrite_db=True`.')
+            else:
+                # indexes are created in existing shards too, as their creation may be deferred
+                self.create_match_tables(f"shard{shard}.", lambda *args: None)
+
+    def shard_path(self, shard):
+        """ Returns path of shard file or None for in-memory databases. """
+        if self.db_path is None:
+            return None
+        root, extension = os.path.splitext(self.db_path)
+        return f"{root}.shard{shard}{extension}"
+
+    def structure_shard(self, structure_id):
+        """ Returns shard of structure. Hash is stable, so structures stay in the same shards between runs. """
+        return zlib.crc32(str(structure_id).encode('utf-8')) % self.num_shards
+
+    def schemas(self):
+        """ Lists prefixes of tables in shards. """
+        return [f"shard{shard}." for shard in range(self.num_shards)]
+
+    def collocation_keys(self):
+        """ Lists (collocation_id, structure_id, key) of collocations from all shards. """
+        for shard_schema in self.schemas():
+            yield from super().collocation_keys(shard_schema)
+
+    def max_match_id(self):
+        """ Returns the biggest match id in all shards or None when there are no matches. """
+        return max((match_id for match_id in map(super().max_match_id, self.schemas()) if match_id is not None),
+                   default=None)
+
+    def add_matches(self, collocations, components, matches, collocation_matches):
+        """ Splits collocations, their components, matches and links between them by shards and inserts them. """
+        for collocation_id, structure_id, _key in collocations:
+            self.collocation_shards[collocation_id] = self.structure_shard(structure_id)
+        match_shards = {match_id: self.collocation_shards[collocation_id]
+                        for collocation_id, match_id in collocation_matches}
+
+        shard_rows = [([], [], [], []) for _ in range(self.num_shards)]
+        for row in collocations:
+            shard_rows[self.collocation_shards[row[0]]][0].append(row)
+        for row in components:
+            shard_rows[self.collocation_shards[row[0]]][1].append(row)
+        for row in matches:
+            shard_rows[match_shards[row[0]]][2].append(row)
+        for row in collocation_matches:
+            shard_rows[self.collocation_shards[row[0]]][3].append(row)
+
+        for shard_schema, rows in zip(self.schemas(), shard_rows):
+            super().add_matches(*rows, schema=shard_schema)
+
+    def num_collocations(self):
+        """ Counts collocations in all shards. """
+        return sum(map(super().num_collocations, self.schemas()))
+
+    def collocations(self):
+        """ Lists (collocation_id, structure_id) of collocations from all shards in order of ids. """
+        return heapq.merge(*map(super().collocations, self.schemas()), key=lambda row: row[0])
+
+    def query_schemas(self, structure_id, collocation_id):
+        """ Lists prefixes of tables in the shard of collocation or structure, or in all shards. """
+        if collocation_id is not None:
+            shard = self.collocation_shards.get(collocation_id)
+            return [] if shard is None else [self.schemas()[shard]]
+        if structure_id is not None:
+            return [self.schemas()[self.structure_shard(structure_id)]]
+        return self.schemas()
+
+    def match_rows(self, structure_id=None, collocation_id=None):
+        """ Lists matched words from the shard of structure or collocation, or from all shards in order of collocation
+        ids. """
+        # matches of a collocation are all in the same shard, so merging keeps their order
+        return heapq.merge(*[super(ShardedStorage, self).match_rows(structure_id, collocation_id, schema)
+                             for schema in self.query_schemas(structure_id, collocation_id)], key=lambda row: row[0])
+
+    def representation_rows(self, structure_id=None, collocation_id=None):
+        """ Lists representations from the shard of structure or collocation, or from all shards in order of
+        collocation ids. """
+        return heapq.merge(*[super(ShardedStorage, self).representation_rows(structure_id, collocation_id, schema)
+                             for schema in self.query_schemas(structure_id, collocation_id)], key=lambda row: row[0])
+
+    def add_representations(self, representations):
+        """ Splits representations by shards and inserts them. """
+        shard_rows = [[] for _ in range(self.num_shards)]
+        for row in representations:
+            shard_rows[self.collocation_shards[row[0]]].append(row)
+
+        for shard_schema, rows in zip(self.schemas(), shard_rows):
+            super().add_representations(rows, schema=shard_schema)
+
+    def collocation_dispersions(self, min_freq):
+        """ Counts collocations in every shard, every structure is in a single shard. """
+        for shard_schema in self.schemas():
+            yield from super().collocation_dispersions(min_freq, shard_schema)
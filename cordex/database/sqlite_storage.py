@@ -0,0 +1,338 @@
+"""
+Storage in sqlite database.
+"""
+import sqlite3
+
+from cordex.database.database import Database
+from cordex.database.storage import Storage
+
+# upserts (INSERT ... ON CONFLICT DO UPDATE) are supported since sqlite 3.24
+UPSERT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+class SQLiteStorage(Storage):
+    """ Stores results in sqlite database (in file `db` or in memory), which also allows continuing processing. """
+    def __init__(self, args):
+        super().__init__()
+        self.db = Database(args)
+        self.strings = self.db.strings
+        self.is_ud = args['is_ud']
+        self.msd_column, self.msd0_column = ('udpos', 'upos') if self.is_ud else ('xpos', 'xpos0')
+        self.word_count_table = 'WordCountUPOS' if self.is_ud else 'WordCountXPOS'
+
+        # create necessary tables
+        self.db.init("CREATE TABLE Files ( filename varchar(2048) )")
+
+        self.init_match_tables()
+        self.db.init("""CREATE TABLE Dispersions (
+            structure_id varchar(64),
+            component_id varchar(64),
+            lemma varchar(128),
+            dispersion INTEGER)
+            """)
+        self.db.init_index("disp_key", "Dispersions", "structure_id, component_id, lemma", deferred=True)
+
+        if self.is_ud:
+            self.db.init("""CREATE TABLE UniqWords (
+                uw_id INTEGER PRIMARY KEY,
+                lemma INTEGER,
+                udpos INTEGER,
+                upos INTEGER,
+                text INTEGER,
+                frequency int
+                )""")
+            self.db.init("CREATE TABLE WordCountUPOS (lemma INTEGER, upos varchar(32), frequency int)")
+            # unique index is needed for upserts while loading
+            self.db.init_index("lemma_msd_text_on_uw", "UniqWords", "lemma, udpos, text", unique=True)
+            self.db.init_index("lemma_msd0_on_wc", "WordCountUPOS", "lemma, upos")
+        else:
+            self.db.init("""CREATE TABLE UniqWords (
+                            uw_id INTEGER PRIMARY KEY,
+                            lemma INTEGER,
+                            xpos INTEGER,
+                            text INTEGER,
+                            frequency int
+                            )""")
+            self.db.init("CREATE TABLE WordCountXPOS (lemma INTEGER, xpos0 char, frequency int)")
+            # unique index is needed for upserts while loading
+            self.db.init_index("lemma_msd_text_on_uw", "UniqWords", "lemma, xpos, text", unique=True)
+            self.db.init_index("lemma_msd0_on_wc", "WordCountXPOS", "lemma, xpos0")
+        self.db.init("CREATE TABLE NumWords (id INTEGER PRIMARY KEY, n INTEGER)")
+
+        self.db.init_index("lemma_on_uw", "UniqWords", "lemma", deferred=True)
+
+        # words are upserted while unique index on (lemma, msd, text) exists
+        self.unique_words = self.is_unique_index('lemma_msd_text_on_uw')
+
+    def init_match_tables(self):
+        """ Creates tables of collocations, matches and representations. """
+        self.create_match_tables('', self.db.init)
+
+    def create_match_tables(self, schema, init):
+        """ Creates tables of collocations, matches and representations in database `schema` (prefix of table names)
+        using `init` for creation of tables. """
+        init(f"""CREATE TABLE {schema}Collocations (
+            collocation_id INTEGER PRIMARY KEY,
+            structure_id varchar(8),
+            key varchar(64))
+            """)
+        init(f"""CREATE TABLE {schema}CollocationComponents (
+            collocation_id INTEGER,
+            component_id varchar(8),
+            lemma INTEGER,
+            FOREIGN KEY(collocation_id) REFERENCES Collocations(collocation_id))
+            """)
+        if self.is_ud:
+            init(f"""CREATE TABLE {schema}Matches (
+                match_id INTEGER,
+                component_id INTEGER NOT NULL,
+                word_lemma INTEGER NOT NULL,
+                word_id varchar(32) NOT NULL,
+                sentence_id varchar(32) NOT NULL,
+                word_udpos INTEGER NOT NULL,
+                word_text INTEGER NOT NULL)
+                """)
+        else:
+            init(f"""CREATE TABLE {schema}Matches (
+                            match_id INTEGER,
+                            component_id INTEGER NOT NULL,
+                            word_lemma INTEGER NOT NULL,
+                            word_id varchar(32) NOT NULL,
+                            sentence_id varchar(32) NOT NULL,
+                            word_xpos INTEGER NOT NULL,
+                            word_text INTEGER NOT NULL)
+                            """)
+        init(f"""CREATE TABLE {schema}CollocationMatches (
+            mid_match_id INTEGER,
+            mid_collocation_id INTEGER,
+            FOREIGN KEY(mid_collocation_id) REFERENCES Collocations(collocation_id),
+            FOREIGN KEY(mid_match_id) REFERENCES Matches(match_id))
+            """)
+        init(f"""CREATE TABLE {schema}Representations (
+            collocation_id INTEGER,
+            component_id INTEGER,
+            text varchar(32),
+            msd varchar(32),
+            FOREIGN KEY(collocation_id) REFERENCES Collocations(collocation_id))
+            """)
+
+        # collocation ids are kept in memory while loading, so no index is needed until all files are loaded
+        self.db.init_index(f"{schema}key_sid_c", "Collocations", "structure_id, key", unique=True, deferred=True)
+        self.db.init_index(f"{schema}sid_c", "Collocations", "structure_id", deferred=True)
+        self.db.init_index(f"{schema}mmid_cm", "CollocationMatches", "mid_collocation_id", deferred=True)
+        self.db.init_index(f"{schema}mid_m", "Matches", "match_id", deferred=True)
+        self.db.init_index(f"{schema}col_r", "Representations", "collocation_id", deferred=True)
+
+    def is_file_loaded(self, fname):
+        """ Checks whether file is already stored. """
+        return self.db.execute("SELECT * FROM Files WHERE filename=?", (fname,)).fetchone() is not None
+
+    def file_loaded(self, fname):
+        """ Stores information that file is processed. File is committed together with its results. """
+        self.db.execute("INSERT INTO Files (filename) VALUES (?)", (fname,))
+        self.db.file_loaded()
+
+    def commit(self):
+        """ Commits changes. """
+        self.db.commit()
+
+    def loading_done(self):
+        """ Commits changes and creates deferred indexes. """
+        self.db.commit()
+        self.db.create_deferred_indexes()
+
+    def is_step_done(self, step_name):
+        """ Checks whether step results are in database. """
+        return self.db.is_step_done(step_name)
+
+    def step_is_done(self, step_name):
+        """ Completes and stores step. """
+        self.db.step_is_done(step_name)
+
+    def collocation_keys(self, schema=''):
+        """ Lists (collocation_id, structure_id, key) of all collocations. """
+        return self.db.execute(f"SELECT collocation_id, structure_id, key FROM {schema}Collocations")
+
+    def max_match_id(self, schema=''):
+        """ Returns the biggest match id or None when there are no matches. """
+        return self.db.execute(f"SELECT MAX(match_id) FROM {schema}Matches").fetchone()[0]
+
+    def add_matches(self, collocations, components, matches, collocation_matches, schema=''):
+        """ Inserts collocations, their components, matches and links between them in bulk. """
+        self.db.executemany(f"INSERT INTO {schema}Collocations (collocation_id, structure_id, key) VALUES (?,?,?)",
+                            collocations)
+        self.db.executemany(f"""INSERT INTO {schema}CollocationComponents (collocation_id, component_id, lemma)
+                            VALUES (?,?,?)""", components)
+        self.db.executemany(f"""INSERT INTO {schema}Matches (match_id, component_id, word_lemma, word_text,
+                            word_{self.msd_column}, word_id, sentence_id) VALUES (?,?,?,?,?,?,?)""", matches)
+        self.db.executemany(f"INSERT INTO {schema}CollocationMatches (mid_collocation_id, mid_match_id) VALUES (?,?)",
+                            collocation_matches)
+
+    def num_collocations(self, schema=''):
+        """ Counts collocations. """
+        return int(self.db.execute(f"SELECT Count(*) FROM {schema}Collocations").fetchone()[0])
+
+    def collocations(self, schema=''):
+        """ Lists (collocation_id, structure_id) of all collocations in order of ids. """
+        return self.db.execute(f"SELECT collocation_id, structure_id FROM {schema}Collocations ORDER BY collocation_id")
+
+    @staticmethod
+    def collocation_condition(structure_id, collocation_id):
+        """ Returns condition on Collocations for filtering by structure or collocation and its parameters. """
+        if collocation_id is not None:
+            return "WHERE collocation_id=:collocation_id", {'collocation_id': collocation_id}
+        if structure_id is not None:
+            return "WHERE structure_id=:structure_id", {'structure_id': structure_id}
+        return "", {}
+
+    def match_rows(self, structure_id=None, collocation_id=None, schema=''):
+        """ Lists matched words with a single ordered query. """
+        condition, params = SQLiteStorage.collocation_condition(structure_id, collocation_id)
+        return self.db.execute(f"""SELECT collocation_id, structure_id, match_id, component_id, word_lemma, word_text,
+                               word_{self.msd_column}, word_id, sentence_id
+                               FROM {schema}Collocations AS Collocations
+                               JOIN {schema}CollocationMatches AS CollocationMatches
+                               ON CollocationMatches.mid_collocation_id=Collocations.collocation_id
+                               JOIN {schema}Matches AS Matches ON Matches.match_id=CollocationMatches.mid_match_id
+                               {condition}
+                               ORDER BY collocation_id, match_id, Matches.rowid""", params)
+
+    def representation_rows(self, structure_id=None, collocation_id=None, schema=''):
+        """ Lists representations with a single ordered query. """
+        condition, params = SQLiteStorage.collocation_condition(structure_id, collocation_id)
+        return self.db.execute(f"""SELECT collocation_id, component_id, text, msd FROM {schema}Representations
+                               AS Representations
+                               WHERE collocation_id IN (SELECT collocation_id FROM {schema}Collocations {condition})
+                               ORDER BY collocation_id, Representations.rowid""", params)
+
+    def add_representations(self, representations, schema=''):
+        """ Adds representations to database. """
+        self.db.executemany(f"""INSERT INTO {schema}Representations (collocation_id, component_id, text, msd)
+                            VALUES (?,?,?,?)""", representations)
+
+    def collocation_dispersions(self, min_freq, schema=''):
+        """ Counts collocations in one pass, only frequent ones (with at least `min_freq` matches) are considered. """
+        if min_freq > 1:
+            frequent = f"""WHERE collocation_id IN (SELECT mid_collocation_id FROM {schema}CollocationMatches
+                           GROUP BY mid_collocation_id HAVING COUNT(*) >= :min_freq)"""
+        else:
+            frequent = ""
+
+        return self.db.execute(f"""SELECT structure_id, component_id, lemma, COUNT(*) FROM {schema}Collocations
+                               JOIN {schema}CollocationComponents USING (collocation_id) {frequent}
+                               GROUP BY structure_id, component_id, lemma""", {'min_freq': min_freq})
+
+    def store_dispersions(self, dispersions):
+        """ Stores dispersions in sql database. """
+        self.db.executemany("INSERT INTO Dispersions (structure_id, component_id, lemma, dispersion) VALUES (?, ?, ?, ?)",
+                            dispersions)
+
+    def load_dispersions(self):
+        """ Lists dispersions stored in database. """
+        return self.db.execute("SELECT * FROM Dispersions")
+
+    def add_word_counts(self, counts, num_words):
+        """ Upserts word frequencies. """
+        if self.unique_words and UPSERT_SUPPORTED:
+            if self.is_ud:
+                # upos is stored separately, so that words may be grouped by it
+                self.db.executemany("""INSERT INTO UniqWords (lemma, udpos, upos, text, frequency) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (lemma, udpos, text) DO UPDATE SET frequency=frequency + excluded.frequency""",
+                                    ((lemma, msd, upos, text, freq) for (lemma, msd, text), (freq, upos) in counts))
+            else:
+                self.db.executemany("""INSERT INTO UniqWords (lemma, xpos, text, frequency) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (lemma, xpos, text) DO UPDATE SET frequency=frequency + excluded.frequency""",
+                                    ((lemma, msd, text, freq) for (lemma, msd, text), (freq, _upos) in counts))
+        else:
+            # upserts are not possible once words were lowercased (files added to a database after that may have
+            # duplicate (lemma, msd, text) combinations) nor on sqlite versions before 3.24
+            for (lemma, msd, text), (freq, upos) in counts:
+                params = (freq, lemma, msd, text)
+                res = self.db.execute(f"""UPDATE UniqWords SET frequency=frequency + ?
+                    WHERE lemma=? AND {self.msd_column}=? AND text=?""", params)
+
+                if res.rowcount == 0:
+                    if self.is_ud:
+                        self.db.execute("""INSERT INTO UniqWords (frequency, lemma, udpos, text, upos)
+                            VALUES (?, ?, ?, ?, ?)""", params + (upos,))
+                    else:
+                        self.db.execute("""INSERT INTO UniqWords (frequency, lemma, xpos, text)
+                            VALUES (?, ?, ?, ?)""", params)
+
+        self.db.execute("INSERT INTO NumWords (n) VALUES (?)", (num_words,))
+
+    def is_unique_index(self, index_name):
+        """ Checks whether index on UniqWords is unique. """
+        for index_info in self.db.execute("PRAGMA index_list(UniqWords)"):
+            if index_info[1] == index_name:
+                return bool(index_info[2])
+        return False
+
+    def words(self):
+        """ Lists words in order of ids. """
+        return self.db.execute(f"SELECT uw_id, lemma, {self.msd_column}, text, frequency FROM UniqWords ORDER BY uw_id")
+
+    def update_word_texts(self, updates):
+        """ Changes texts of words. Unique index is replaced, as changes may create duplicate (lemma, msd, text)
+        combinations. """
+        if self.unique_words:
+            self.db.execute("DROP INDEX lemma_msd_text_on_uw")
+            self.db.execute(f"CREATE INDEX lemma_msd_text_on_uw ON UniqWords (lemma, {self.msd_column}, text)")
+            self.unique_words = False
+
+        self.db.executemany("UPDATE UniqWords SET text=? WHERE uw_id=?", updates)
+
+    def num_all_words(self):
+        """ Counts all words. """
+        return int(self.db.execute("SELECT sum(n) FROM NumWords").fetchone()[0])
+
+    def generate_word_counts(self):
+        """ Sums frequencies with a single query, msds are grouped by their interned strings (upos or the first letter
+        of xpos). """
+        self.db.strings.flush()
+        if self.is_ud:
+            self.db.execute("""INSERT INTO WordCountUPOS (lemma, upos, frequency)
+                            SELECT lemma, string, SUM(frequency) FROM UniqWords
+                            JOIN Strings ON Strings.string_id=UniqWords.upos
+                            GROUP BY lemma, string""")
+        else:
+            self.db.execute("""INSERT INTO WordCountXPOS (lemma, xpos0, frequency)
+                            SELECT lemma, substr(string, 1, 1), SUM(frequency) FROM UniqWords
+                            JOIN Strings ON Strings.string_id=UniqWords.xpos
+                            GROUP BY lemma, substr(string, 1, 1)""")
+
+    def num_word_rows(self):
+        """ Returns the number of words and word counts and the number of distinct lemmas. """
+        num_rows = self.db.execute(f"""SELECT (SELECT COUNT(*) FROM UniqWords) +
+                                   (SELECT COUNT(*) FROM {self.word_count_table})""").fetchone()[0]
+        num_lemmas = self.db.execute("SELECT COUNT(DISTINCT lemma) FROM UniqWords").fetchone()[0]
+        return num_rows, num_lemmas
+
+    def all_words(self):
+        """ Lists all words ordered by lemma, descending frequency and id. """
+        return self.db.execute(f"""SELECT lemma, {self.msd_column}, text, frequency FROM UniqWords
+                               ORDER BY lemma, frequency DESC, uw_id""")
+
+    def all_word_counts(self):
+        """ Lists all word counts. """
+        return self.db.execute(f"SELECT lemma, {self.msd0_column}, frequency FROM {self.word_count_table}")
+
+    def lemma_words(self, lemma):
+        """ Lists words of lemma ordered by descending frequency and id. """
+        return self.db.execute(f"""SELECT {self.msd_column}, text, frequency FROM UniqWords WHERE lemma=?
+                               ORDER BY frequency DESC, uw_id""", (lemma,))
+
+    def lemma_word_counts(self, lemma):
+        """ Lists word counts of lemma. """
+        return self.db.execute(f"SELECT {self.msd0_column}, frequency FROM {self.word_count_table} WHERE lemma=?",
+                               (lemma,))
+
+    def word_texts(self, lemma, msd):
+        """ Lists texts and frequencies of words with lemma and msd. """
+        return self.db.execute(f"SELECT text, frequency FROM UniqWords WHERE lemma=? AND {self.msd_column}=?",
+                               (lemma, msd))
+
+    def word_count(self, lemma, msd0):
+        """ Returns word count of lemma and msd0. """
+        return self.db.execute(f"""SELECT frequency FROM {self.word_count_table} WHERE lemma=? AND {self.msd0_column}=?
+                               LIMIT 1""", (lemma, msd0)).fetchone()[0]
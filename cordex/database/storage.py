@@ -0,0 +1,139 @@
+"""
+Interface of storage, that holds loaded files, collocations, matches, representations and word counts.
+"""
+
+
+class Storage:
+    """
+    Storage of extraction results. Lemmas, texts and msds of words are stored as ids of strings interned in `strings`.
+    Implementations are `SQLiteStorage` (see `cordex.database.sqlite_storage`) and `MemoryStorage` (see
+    `cordex.database.memory_storage`).
+    """
+    def __init__(self):
+        self.strings = None
+
+    # loading state
+    def is_file_loaded(self, fname):
+        """ Checks whether file is already stored. """
+        raise NotImplementedError("Storage does not implement: is_file_loaded")
+
+    def file_loaded(self, fname):
+        """ Marks file as stored. """
+        raise NotImplementedError("Storage does not implement: file_loaded")
+
+    def commit(self):
+        """ Makes stored results persistent. """
+        raise NotImplementedError("Storage does not implement: commit")
+
+    def loading_done(self):
+        """ Prepares storage for queries after all files are loaded. """
+        raise NotImplementedError("Storage does not implement: loading_done")
+
+    def is_step_done(self, step_name):
+        """ Checks whether step results are stored. """
+        raise NotImplementedError("Storage does not implement: is_step_done")
+
+    def step_is_done(self, step_name):
+        """ Completes and stores step. """
+        raise NotImplementedError("Storage does not implement: step_is_done")
+
+    # collocations and matches
+    def collocation_keys(self):
+        """ Lists (collocation_id, structure_id, key) of all collocations. """
+        raise NotImplementedError("Storage does not implement: collocation_keys")
+
+    def max_match_id(self):
+        """ Returns the biggest match id or None when there are no matches. """
+        raise NotImplementedError("Storage does not implement: max_match_id")
+
+    def add_matches(self, collocations, components, matches, collocation_matches):
+        """ Adds new collocations (collocation_id, structure_id, key), their components (collocation_id,
+        component_id, lemma), matched words (match_id, component_id, lemma, text, msd, word_id, sentence_id) and links
+        between collocations and matches (collocation_id, match_id). """
+        raise NotImplementedError("Storage does not implement: add_matches")
+
+    def num_collocations(self):
+        """ Counts collocations. """
+        raise NotImplementedError("Storage does not implement: num_collocations")
+
+    def collocations(self):
+        """ Lists (collocation_id, structure_id) of all collocations in order of ids. """
+        raise NotImplementedError("Storage does not implement: collocations")
+
+    def match_rows(self, structure_id=None, collocation_id=None):
+        """ Lists matched words (collocation_id, structure_id, match_id, component_id, lemma, text, msd, word_id,
+        sentence_id) of all collocations (or only of given structure or collocation) in order of collocation ids,
+        match ids and insertion. """
+        raise NotImplementedError("Storage does not implement: match_rows")
+
+    def representation_rows(self, structure_id=None, collocation_id=None):
+        """ Lists representations (collocation_id, component_id, text, msd) of all collocations (or only of given
+        structure or collocation) in order of collocation ids and insertion. """
+        raise NotImplementedError("Storage does not implement: representation_rows")
+
+    def add_representations(self, representations):
+        """ Adds representations (collocation_id, component_id, text, msd). """
+        raise NotImplementedError("Storage does not implement: add_representations")
+
+    def collocation_dispersions(self, min_freq):
+        """ Counts collocations with at least `min_freq` matches per (structure_id, component_id, lemma). """
+        raise NotImplementedError("Storage does not implement: collocation_dispersions")
+
+    def store_dispersions(self, dispersions):
+        """ Stores dispersions (structure_id, component_id, lemma, dispersion). """
+        raise NotImplementedError("Storage does not implement: store_dispersions")
+
+    def load_dispersions(self):
+        """ Lists stored dispersions (structure_id, component_id, lemma, dispersion). """
+        raise NotImplementedError("Storage does not implement: load_dispersions")
+
+    # words
+    def add_word_counts(self, counts, num_words):
+        """ Adds frequencies of words, where `counts` maps (lemma, msd, text) to (frequency, upos). Upos is None for
+        JOS words. """
+        raise NotImplementedError("Storage does not implement: add_word_counts")
+
+    def words(self):
+        """ Lists words (uw_id, lemma, msd, text, frequency) in order of ids. """
+        raise NotImplementedError("Storage does not implement: words")
+
+    def update_word_texts(self, updates):
+        """ Changes texts of words with given ids, `updates` are (text, uw_id) pairs. Afterwards (lemma, msd, text)
+        combinations of words may no longer be unique. """
+        raise NotImplementedError("Storage does not implement: update_word_texts")
+
+    def num_all_words(self):
+        """ Counts all loaded words. """
+        raise NotImplementedError("Storage does not implement: num_all_words")
+
+    def generate_word_counts(self):
+        """ Sums frequencies of words per lemma and upos (or the first letter of xpos). """
+        raise NotImplementedError("Storage does not implement: generate_word_counts")
+
+    def num_word_rows(self):
+        """ Returns the number of words and word counts and the number of distinct lemmas. """
+        raise NotImplementedError("Storage does not implement: num_word_rows")
+
+    def all_words(self):
+        """ Lists all words (lemma, msd, text, frequency) ordered by lemma, descending frequency and id. """
+        raise NotImplementedError("Storage does not implement: all_words")
+
+    def all_word_counts(self):
+        """ Lists all word counts (lemma, msd0, frequency). """
+        raise NotImplementedError("Storage does not implement: all_word_counts")
+
+    def lemma_words(self, lemma):
+        """ Lists words (msd, text, frequency) of lemma ordered by descending frequency and id. """
+        raise NotImplementedError("Storage does not implement: lemma_words")
+
+    def lemma_word_counts(self, lemma):
+        """ Lists word counts (msd0, frequency) of lemma. """
+        raise NotImplementedError("Storage does not implement: lemma_word_counts")
+
+    def word_texts(self, lemma, msd):
+        """ Lists texts and frequencies of words with lemma and msd. """
+        raise NotImplementedError("Storage does not implement: word_texts")
+
+    def word_count(self, lemma, msd0):
+        """ Returns word count of lemma and msd0. """
+        raise NotImplementedError("Storage does not implement: word_count")
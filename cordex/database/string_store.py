@@ -0,0 +1,28 @@
+"""
+Run-wide table of interned strings, that is persisted in database.
+"""
+from cordex.words.compact import StringTable
+
+
+class StringStore(StringTable):
+    """
+    Maps strings (lemmas, texts and msds) to integer ids, which are used in database tables instead of strings. All
+    strings are kept in memory, while new ones are written to database on commit.
+    """
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.db.init("CREATE TABLE Strings (string_id INTEGER PRIMARY KEY, string varchar(64))")
+
+        for string_id, value in self.db.execute("SELECT string_id, string FROM Strings ORDER BY string_id"):
+            self.ids[value] = string_id
+            self.values.append(value)
+        self.num_stored = len(self.values)
+
+    def flush(self):
+        """ Writes new strings to database. """
+        if self.num_stored < len(self.values):
+            self.db.executemany("INSERT INTO Strings (string_id, string) VALUES (?, ?)",
+                                ((string_id, self.values[string_id])
+                                 for string_id in range(self.num_stored, len(self.values))))
+            self.num_stored = len(self.values)
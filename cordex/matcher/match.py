@@ -1,8 +1,7 @@
 """
 Class for loading matches
 """
-from ast import literal_eval
-
+from cordex.utils.converter import decode_udpos
 from cordex.words.word import WordUD, WordJOS
 
 
@@ -15,50 +14,66 @@ class StructureMatch:
         self.representations = {}
     
     @staticmethod
-    def from_db(db, collocation_id, structure, is_ud):
-        """ Loads matches from database. """
-        result = StructureMatch(collocation_id, structure)
-        prev_match_id = None
-
+    def word_from_row(strings, row, is_ud):
+        """ Creates word from a row of Matches table (lemma, text, msd, word_id and sentence_id). """
+        word_lemma, word_text, word_msd, word_id, sentence_id = row
+        word_lemma, word_text, word_msd = strings[word_lemma], strings[word_text], strings[word_msd]
+        int_word_id = int(word_id) if word_id[0] in '0123456789' else int(word_id[1:])
         if is_ud:
-            stmt = """SELECT match_id, component_id, word_lemma, word_text, word_udpos, word_id, sentence_id
-                      FROM CollocationMatches 
-                      JOIN Matches ON Matches.match_id=CollocationMatches.mid_match_id 
-                      WHERE mid_collocation_id=? 
-                      ORDER BY match_id"""
+            return WordUD(word_lemma, '', sentence_id, word_id, int_word_id, word_text, False, feats=decode_udpos(word_msd))
+        return WordJOS(word_lemma, word_msd, sentence_id, word_id, int_word_id, word_text, False, False)
 
-            for row in db.execute(stmt, (collocation_id,)):
-                match_id, component_id, word_lemma, word_text, word_udpos, word_id, sentence_id = row
+    @staticmethod
+    def from_db(storage, collocation_id, structure, is_ud):
+        """ Loads matches of a single collocation from storage. """
+        for result in StructureMatch.from_db_bulk(storage, [structure], is_ud, collocation_id=collocation_id):
+            return result
+        return StructureMatch(collocation_id, structure)
 
-                if match_id != prev_match_id:
-                    result.matches.append({})
-                    prev_match_id = match_id
+    @staticmethod
+    def from_db_bulk(storage, structures, is_ud, structure_id=None, collocation_id=None, with_representations=True):
+        """ Loads matches of all collocations (or only collocations of structure with `structure_id` or a single
+        collocation) in one ordered pass and yields them in order of collocation ids. """
+        representations = ()
+        if with_representations:
+            representations = storage.representation_rows(structure_id, collocation_id)
+        return StructureMatch.from_rows(storage.strings, {s.id: s for s in structures},
+                                        storage.match_rows(structure_id, collocation_id), representations, is_ud)
+
+    @staticmethod
+    def from_rows(strings, structures_dict, rows, representations, is_ud):
+        """ Creates matches from match rows and representation rows (see `Storage.match_rows` and
+        `Storage.representation_rows`), that are ordered by collocation ids, and yields them in that order. """
+        representations = iter(representations)
+        next_representation = next(representations, None)
+
+        result = None
+        prev_collocation_id = None
+        prev_match_id = None
+        for row in rows:
+            collocation_id, sid, match_id, component_id = row[:4]
 
-                word_udpos = literal_eval(word_udpos)
-                int_word_id = int(word_id) if word_id[0] in '0123456789' else int(word_id[1:])
-                result.matches[-1][str(component_id)] = WordUD(word_lemma, '', sentence_id, word_id, int_word_id, word_text, False, feats=word_udpos)
+            if collocation_id != prev_collocation_id:
+                prev_collocation_id = collocation_id
+                if result is not None:
+                    yield result
+                result = StructureMatch(collocation_id, structures_dict[sid])
 
-        else:
-            stmt = """SELECT match_id, component_id, word_lemma, word_text, word_xpos, word_id, sentence_id
-                      FROM CollocationMatches 
-                      JOIN Matches ON Matches.match_id=CollocationMatches.mid_match_id 
-                      WHERE mid_collocation_id=? 
-                      ORDER BY match_id"""
+                # representations are read in the same order as collocations
+                while next_representation is not None and next_representation[0] <= collocation_id:
+                    rep_collocation_id, rep_component_id, text, msd = next_representation
+                    if rep_collocation_id == collocation_id:
+                        result.representations[str(rep_component_id)] = (text, msd)
+                    next_representation = next(representations, None)
 
-            for row in db.execute(stmt, (collocation_id,)):
-                match_id, component_id, word_lemma, word_text, word_xpos, word_id, sentence_id = row
+            if match_id != prev_match_id:
+                result.matches.append({})
+                prev_match_id = match_id
 
-                if match_id != prev_match_id:
-                    result.matches.append({})
-                    prev_match_id = match_id
+            result.matches[-1][str(component_id)] = StructureMatch.word_from_row(strings, row[4:], is_ud)
 
-                int_word_id = int(word_id) if word_id[0] in '0123456789' else int(word_id[1:])
-                result.matches[-1][str(component_id)] = WordJOS(word_lemma, word_xpos, sentence_id, word_id, int_word_id, word_text, False, False)
-        
-        for component_id, text, msd in db.execute("SELECT component_id, text, msd FROM Representations WHERE collocation_id=?", (collocation_id,)):
-            result.representations[str(component_id)] = (text, msd)
-        
-        return result
+        if result is not None:
+            yield result
 
     def distinct_forms(self):
         """ Counts all distinct forms. """
@@ -1,166 +1,218 @@
 """
 A class for storing matches.
 """
+import copy
 import gc
-from collections import defaultdict
-from ast import literal_eval
+import os
+import pickle
+import tempfile
+from itertools import groupby
 from time import time
 import logging
 
 from cordex.matcher.match import StructureMatch
+from cordex.representations.lookup import load_lookup_lexicon
 from cordex.representations.representation_assigner import RepresentationAssigner
 from cordex.utils.progress_bar import progress
+from cordex.utils.converter import encode_udpos
+from cordex.utils.parallel import ordered_imap, worker_state
+
+# number of collocations, whose representations are formed together in a worker process
+REPRESENTATION_BATCH_SIZE = 1000
+# number of matches, that are inserted into storage together
+MATCH_BATCH_SIZE = 10000
+
+def _form_representations(rows):
+    """ Forms representations of a batch of collocations from their match rows in a worker process. """
+    word_renderer, is_ud = worker_state['word_renderer'], worker_state['is_ud']
+    # only path of lexicon is passed to workers, as it is loaded once per process (see `load_lookup_lexicon`)
+    lexicon_path = worker_state['lookup_lexicon_path']
+    lookup_lexicon = load_lookup_lexicon(lexicon_path) if lexicon_path is not None else None
+    result = []
+    for match in StructureMatch.from_rows(word_renderer.strings, worker_state['structures'], rows, (), is_ud):
+        RepresentationAssigner.set_representations(match, word_renderer, is_ud, {},
+                                                   lookup_lexicon=lookup_lexicon, lookup_api=None)
+        result.extend(MatchStore.representation_rows(match))
+    return result
+
+
+class MatchSpool:
+    """ Match rows (see `MatchStore.match_rows`) of chunks of a file, that are kept by structures, so they are read in
+    the same order as if the whole file was matched at once. When `on_disk` is set, rows of every chunk are written to
+    a temporary file (in `directory`), so that only rows of a single chunk are kept in memory. Spool may be passed
+    between processes. Temporary file is removed when rows are read or spool is closed. """
+    def __init__(self, num_structures, on_disk, directory=None):
+        # lists of rows of chunks, or offsets of pickled rows of chunks in temporary file, for every structure
+        self.parts = [[] for _ in range(num_structures)]
+        self.path = None
+        if on_disk:
+            fd, self.path = tempfile.mkstemp(prefix='cordex-', suffix='.matches', dir=directory)
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Removes temporary file, spool may not be read afterwards. """
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add(self, structure_rows):
+        """ Adds rows of a chunk, given as lists of rows of every structure. """
+        if self.path is None:
+            for part, rows in zip(self.parts, structure_rows):
+                part.append(rows)
+            return
+
+        with open(self.path, 'ab') as f:
+            for part, rows in zip(self.parts, structure_rows):
+                if rows:
+                    part.append(f.tell())
+                    pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def rows(self):
+        """ Generates all rows structure by structure and removes temporary file. """
+        if self.path is None:
+            for part in self.parts:
+                for rows in part:
+                    yield from rows
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                for part in self.parts:
+                    for offset in part:
+                        f.seek(offset)
+                        yield from pickle.load(f)
+        finally:
+            self.close()
 
 
 class MatchStore:
-    def __init__(self, args, db):
-        self.db = db
+    def __init__(self, args, storage):
+        self.storage = storage
         self.dispersions = {}
         self.min_freq = args['min_freq']
         self.is_ud = args['is_ud']
+        self.workers = args['workers']
 
-        # create necessary tables
-        self.db.init("""CREATE TABLE Collocations (
-            collocation_id INTEGER PRIMARY KEY,
-            structure_id varchar(8),
-            key varchar(256))
-            """)
-        if self.is_ud:
-            self.db.init("""CREATE TABLE Matches (
-                match_id INTEGER,
-                component_id INTEGER NOT NULL,
-                word_lemma varchar(32) NOT NULL,
-                word_id varchar(32) NOT NULL,
-                sentence_id varchar(32) NOT NULL,
-                word_udpos varchar(32) NOT NULL,
-                word_text varchar(32) NOT NULL)
-                """)
-        else:
-            self.db.init("""CREATE TABLE Matches (
-                            match_id INTEGER,
-                            component_id INTEGER NOT NULL,
-                            word_lemma varchar(32) NOT NULL,
-                            word_id varchar(32) NOT NULL,
-                            sentence_id varchar(32) NOT NULL,
-                            word_xpos varchar(16) NOT NULL,
-                            word_text varchar(32) NOT NULL)
-                            """)
-        self.db.init("""CREATE TABLE CollocationMatches (
-            mid_match_id INTEGER,
-            mid_collocation_id INTEGER,
-            FOREIGN KEY(mid_collocation_id) REFERENCES Collocations(collocation_id),
-            FOREIGN KEY(mid_match_id) REFERENCES Matches(match_id))
-            """)
-        self.db.init("""CREATE TABLE Representations (
-            collocation_id INTEGER,
-            component_id INTEGER,
-            text varchar(32),
-            msd varchar(32),
-            FOREIGN KEY(collocation_id) REFERENCES Collocations(collocation_id))
-            """)
-        self.db.init("""CREATE TABLE Dispersions (
-            structure_id varchar(64),
-            component_id varchar(64),
-            lemma varchar(128),
-            dispersion INTEGER)
-            """)
-        
-        self.db.init("CREATE INDEX key_sid_c ON Collocations (key, structure_id)")
-        self.db.init("CREATE INDEX sid_c ON Collocations (structure_id)")
-        self.db.init("CREATE INDEX mmid_cm ON CollocationMatches (mid_collocation_id)")
-        self.db.init("CREATE INDEX mid_m ON Matches (match_id)")
-        self.db.init("CREATE INDEX col_r ON Representations (collocation_id)")
-        self.db.init("CREATE INDEX disp_key ON Dispersions (structure_id, component_id, lemma)")
-
-        match_num = self.db.execute("SELECT MAX(match_id) FROM Matches").fetchone()[0]
+        match_num = self.storage.max_match_id()
         self.match_num = 0 if match_num is None else match_num + 1
 
-    def _add_match(self, key, match):
-        """ Inserts a match to database. """
-        structure_id, key_str = key[0], str(key[1:])
-        cid = self.db.execute("SELECT collocation_id FROM Collocations WHERE key=? AND structure_id=?",
-                              (key_str, structure_id)).fetchone()
-
-        if cid is None:
-            self.db.execute("INSERT INTO Collocations (structure_id, key) VALUES (?,?)",
-                            (structure_id, key_str))
-            cid = self.db.execute("SELECT collocation_id FROM Collocations WHERE key=? AND structure_id=?",
-                                  (key_str, structure_id)).fetchone()
-        
-        for component_id, word in match.items():
-            if self.is_ud:
-                self.db.execute("""
-                INSERT INTO Matches (match_id, component_id, word_lemma, word_text, word_udpos, word_id, sentence_id) 
-                VALUES (:match_id, :component_id, :word_lemma, :word_text, :word_udpos, :word_id, :sentence_id)""", {
-                    "component_id": component_id,
-                    "match_id": self.match_num,
-                    "word_lemma": word.lemma,
-                    "word_udpos": str(word.udpos),
-                    "word_text": word.text,
-                    "word_id": word.id,
-                    "sentence_id": word.sentence_id,
-                })
-            else:
-                self.db.execute("""
-                INSERT INTO Matches (match_id, component_id, word_lemma, word_text, word_xpos, word_id, sentence_id) 
-                VALUES (:match_id, :component_id, :word_lemma, :word_text, :word_xpos, :word_id, :sentence_id)""", {
-                    "component_id": component_id,
-                    "match_id": self.match_num,
-                    "word_lemma": word.lemma,
-                    "word_xpos": word.xpos,
-                    "word_text": word.text,
-                    "word_id": word.id,
-                    "sentence_id": word.sentence_id,
-                })
-
-        self.db.execute("INSERT INTO CollocationMatches (mid_collocation_id, mid_match_id) VALUES (?,?)",
-                        (cid[0], self.match_num))
-        
-        self.match_num += 1
+        # collocation ids are kept in memory, so they do not have to be queried for every match
+        self.collocation_ids = {}
+        for collocation_id, structure_id, key in self.storage.collocation_keys():
+            self.collocation_ids[(structure_id, key)] = collocation_id
+        self.collocation_num = max(self.collocation_ids.values(), default=0) + 1
+
+    @staticmethod
+    def collocation_key(key, string_id):
+        """ Returns compact collocation key, that consists of component ids and ids of their lemmas. """
+        return ' '.join(f'{component_id}:{string_id(lemma)}' for component_id, lemma in key[1:])
+
+    @staticmethod
+    def match_rows(matches, is_ud):
+        """ Converts matches into compact rows, that may be passed between processes. """
+        rows = []
+        for structure, nms in matches.items():
+            for match, key in nms:
+                components = [(component_id, word.lemma, word.text, encode_udpos(word.udpos) if is_ud else word.xpos, word.id,
+                               word.sentence_id) for component_id, word in match.items()]
+                rows.append((key, components))
+        return rows
 
     def add_matches(self, matches):
         """ Add multiple matches. """
-        for structure, nms in progress(matches.items(), 'adding-matches'):
-            for nm in nms:
-                self._add_match(nm[1], nm[0])
+        self.add_match_rows(MatchStore.match_rows(matches, self.is_ud))
+
+    def add_match_rows(self, rows):
+        """ Add multiple matches in compact form (see `match_rows`). Rows are gathered and inserted in bulk. Lemmas,
+        texts and msds are stored as ids of interned strings. """
+        string_id = self.storage.strings.get_id
+        new_collocations = []
+        collocation_components = []
+        matches = []
+        collocation_matches = []
+
+        for key, components in progress(rows, 'adding-matches'):
+            structure_id, key_str = key[0], MatchStore.collocation_key(key, string_id)
+            cid = self.collocation_ids.get((structure_id, key_str))
+
+            if cid is None:
+                cid = self.collocation_num
+                self.collocation_num += 1
+                self.collocation_ids[(structure_id, key_str)] = cid
+                new_collocations.append((cid, structure_id, key_str))
+                collocation_components.extend((cid, component_id, string_id(lemma)) for component_id, lemma in key[1:])
+
+            for component_id, lemma, text, msd, word_id, sentence_id in components:
+                matches.append((self.match_num, component_id, string_id(lemma), string_id(text), string_id(msd), word_id,
+                                sentence_id))
+            collocation_matches.append((cid, self.match_num))
+
+            self.match_num += 1
+
+            if len(collocation_matches) >= MATCH_BATCH_SIZE:
+                self.storage.add_matches(new_collocations, collocation_components, matches, collocation_matches)
+                new_collocations, collocation_components, matches, collocation_matches = [], [], [], []
+
+        self.storage.add_matches(new_collocations, collocation_components, matches, collocation_matches)
+
+    def snapshot(self):
+        """ Returns read-only copy with dispersions, that does not need storage, so it may be passed to other
+        processes. """
+        snapshot = copy.copy(self)
+        snapshot.storage = None
+        snapshot.collocation_ids = {}
+        return snapshot
 
     def get_matches_for(self, structure):
         """ Get all matches for given structure. """
-        for cid in self.db.execute("SELECT collocation_id FROM Collocations WHERE structure_id=?",
-                                   (structure.id,)):
-            yield StructureMatch.from_db(self.db, cid[0], structure, self.is_ud)
+        return StructureMatch.from_db_bulk(self.storage, [structure], self.is_ud, structure_id=structure.id)
 
-    def add_inserts(self, inserts):
-        """ Adds representations to database. """
+    @staticmethod
+    def representation_rows(match):
+        """ Returns representations of match as (collocation_id, component_id, text, msd) rows. """
+        return [(int(match.match_id), component_id, text, msd)
+                for component_id, (text, msd) in match.representations.items()]
 
-        for match in inserts:
-            for component_id, (text, msd) in match.representations.items():
-                self.db.execute("""
-                    INSERT INTO Representations (collocation_id, component_id, text, msd) 
-                    VALUES (?,?,?,?)""", (match.match_id, component_id, text, msd))
+    def add_inserts(self, inserts):
+        """ Adds representations to storage. """
+        self.storage.add_representations(row for match in inserts for row in MatchStore.representation_rows(match))
 
     def set_representations(self, word_renderer, structures, is_ud, lookup_lexicon=None, lookup_api=False):
         """ Adds representations to matches. """
 
         step_name = 'representation'
-        if self.db.is_step_done(step_name):
+        if self.storage.is_step_done(step_name):
             logging.info("Representation step already done, skipping")
             return
 
+        # lookup api needs representations of all collocations at once, so it is not used in parallel, nor are workers
+        # used when index of words does not fit into memory
+        word_renderer_snapshot = word_renderer.snapshot() if self.workers > 1 and not lookup_api else None
+        if word_renderer_snapshot is not None:
+            self.set_representations_parallel(word_renderer_snapshot, structures, is_ud, lookup_lexicon=lookup_lexicon)
+            self.storage.step_is_done(step_name)
+            return
+        if self.workers > 1 and not lookup_api:
+            logging.info("Index of words does not fit into `word_index_memory`, forming representations in a single "
+                         "process")
+
         num_inserts = 1000
         inserts = []
 
-        structures_dict = {s.id: s for s in structures}
-        num_representations = int(self.db.execute("SELECT Count(*) FROM Collocations").fetchone()[0])
+        num_representations = self.storage.num_collocations()
 
         # preprocess when api is used
         all_representations = []
         if lookup_api:
             # create api queries
-            for cid, sid in progress(self.db.execute("SELECT collocation_id, structure_id FROM Collocations"),
-                                     "representations", total=num_representations):
-                structure = structures_dict[sid]
-                match = StructureMatch.from_db(self.db, cid, structure, is_ud)
+            for match in progress(StructureMatch.from_db_bulk(self.storage, structures, is_ud, with_representations=False),
+                                  "representations", total=num_representations):
                 representations = {}
                 RepresentationAssigner.set_representations(match, word_renderer, is_ud, representations,
                                                            lookup_lexicon=lookup_lexicon, lookup_api=lookup_api)
@@ -168,13 +220,13 @@ class MatchStore:
                 all_representations.append(representations)
 
             # get data results
-            lookup_api.execute_requests(num_representations, self.db, all_representations)
+            lookup_api.execute_requests(num_representations, self.storage, all_representations)
 
         start_time = time()
         i = 0
-        for cid, sid in progress(self.db.execute("SELECT collocation_id, structure_id FROM Collocations"), "representations", total=num_representations):
-            structure = structures_dict[sid]
-            match = StructureMatch.from_db(self.db, cid, structure, is_ud)
+        # representations are not stored yet, so they are not loaded
+        for match in progress(StructureMatch.from_db_bulk(self.storage, structures, is_ud, with_representations=False),
+                              "representations", total=num_representations):
             representations = {}
             RepresentationAssigner.set_representations(match, word_renderer, is_ud, representations, lookup_lexicon=lookup_lexicon, lookup_api=lookup_api)
 
@@ -190,44 +242,63 @@ class MatchStore:
             i += 1
         self.add_inserts(inserts)
 
-        self.db.step_is_done(step_name)
+        self.storage.step_is_done(step_name)
+
+    @staticmethod
+    def collocation_batches(rows, batch_size):
+        """ Splits match rows, that are ordered by collocation ids, into batches of rows of `batch_size`
+        collocations. """
+        batch = []
+        num_collocations = 0
+        for _collocation_id, collocation_rows in groupby(rows, key=lambda row: row[0]):
+            batch.extend(collocation_rows)
+            num_collocations += 1
+            if num_collocations == batch_size:
+                yield batch
+                batch = []
+                num_collocations = 0
+        if batch:
+            yield batch
 
-    def frequency_filter(self, collocation_id):
-        """ Filters by frequency. """
+    def set_representations_parallel(self, word_renderer, structures, is_ud, lookup_lexicon=None):
+        """ Forms representations of batches of collocations in multiple processes, that share read-only copy of
+        words `word_renderer` (see `WordStats.snapshot`). Representations are stored in the same order as in
+        `set_representations`, so outputs are equal. """
+        num_batches = -(-self.storage.num_collocations() // REPRESENTATION_BATCH_SIZE)
+        batches = MatchStore.collocation_batches(self.storage.match_rows(), REPRESENTATION_BATCH_SIZE)
 
-        matches = self.db.execute("SELECT MIN(MAX(COUNT(*), ?), ?) FROM CollocationMatches WHERE mid_collocation_id=?", (self.min_freq - 1, self.min_freq, collocation_id)).fetchone()[0]
-        return matches >= self.min_freq
+        state = {'structures': {s.id: s for s in structures}, 'word_renderer': word_renderer, 'is_ud': is_ud,
+                 'lookup_lexicon_path': lookup_lexicon.file_path if lookup_lexicon is not None else None}
+        tasks = ((batch,) for batch in progress(batches, "representations", total=num_batches))
+        for rows in ordered_imap(_form_representations, tasks, self.workers, state):
+            self.storage.add_representations(rows)
 
     def determine_collocation_dispersions(self):
         """ Allocates collocation dispersions. """
         step_name = 'dispersions'
-        if self.db.is_step_done(step_name):
+        if self.storage.is_step_done(step_name):
             self.load_dispersions()
             return
 
-        dispersions = defaultdict(int)
-        for collocation_id, structure_id, word_tups_str in progress(self.db.execute("SELECT collocation_id, structure_id, key FROM Collocations"), "dispersion"):
-            if not self.frequency_filter(collocation_id):
-                continue
+        strings = self.storage.strings
+        dispersions = {}
+        for structure_id, component_id, lemma, dispersion in progress(
+                self.storage.collocation_dispersions(self.min_freq), "dispersion"):
+            dispersions[(str(structure_id), component_id, strings[lemma])] = dispersion
 
-            word_tups = literal_eval(word_tups_str)
-            for component_id, lemma in word_tups:
-                dispersions[(str(structure_id), component_id, lemma)] += 1
-            
-        self.dispersions = dict(dispersions)
+        self.dispersions = dispersions
         logging.info("Storing dispersions...")
         self.store_dispersions()
 
-        self.db.step_is_done(step_name)
+        self.storage.step_is_done(step_name)
 
     def store_dispersions(self):
-        """ Stores dispersions in sql database. """
-        for (structure_id, component_id, lemma), disp in self.dispersions.items():
-            self.db.execute("INSERT INTO Dispersions (structure_id, component_id, lemma, dispersion) VALUES (?, ?, ?, ?)",
-                            (structure_id, component_id, lemma, disp))
+        """ Stores dispersions. """
+        self.storage.store_dispersions((structure_id, component_id, lemma, disp)
+                                       for (structure_id, component_id, lemma), disp in self.dispersions.items())
 
     def load_dispersions(self):
-        """ Load dispersions when they are in database. """
+        """ Load dispersions when they are stored. """
         self.dispersions = {}
-        for structure_id, component_id, lemma, dispersion in progress(self.db.execute("SELECT * FROM Dispersions"), "load-dispersions"):
+        for structure_id, component_id, lemma, dispersion in progress(self.storage.load_dispersions(), "load-dispersions"):
             self.dispersions[structure_id, component_id, lemma] = dispersion
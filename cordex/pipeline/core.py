@@ -1,18 +1,25 @@
 import os
 import time
 import gc
+import tempfile
+from collections import Counter
+from contextlib import closing
 from pathlib import Path
 
-from cordex.representations.lookup import LookupLexicon, SUPPORTED_LOOKUP_LANGUAGES, LookupApi
+from cordex.representations.lookup import load_lookup_lexicon, SUPPORTED_LOOKUP_LANGUAGES, LookupApi
 from cordex.utils.progress_bar import progress
 from cordex.structures.syntactic_structure import build_structures
-from cordex.matcher.match_store import MatchStore
+from cordex.structures.structure_index import StructureIndex
+from cordex.matcher.match_store import MatchStore, MatchSpool
 from cordex.statistics.word_stats import WordStats
 from cordex.writers.formatter import OutFormatter, OutNoStatFormatter
 from cordex.writers.writer import Writer
-from cordex.readers.loader import load_files
-from cordex.database.database import Database
+from cordex.readers.loader import load_files, list_files, load_file, mark_file_loaded
+from cordex.database.sqlite_storage import SQLiteStorage
+from cordex.database.sharded_storage import ShardedStorage
+from cordex.database.memory_storage import MemoryStorage
 from cordex.utils.time_info import TimeInfo
+from cordex.utils.parallel import ordered_imap, worker_state
 
 from cordex.postprocessors.postprocessor import Postprocessor
 import logging
@@ -21,6 +28,14 @@ logger = logging.getLogger('cordex')
 
 HOME_DIR = str(Path.home())
 
+def _process_file(fname):
+    """ Loads and matches a file in a worker process and returns results in a compact form. """
+    args = worker_state['args']
+    match_spool, word_counts, num_words = Pipeline.match_chunks(load_file(fname, args), worker_state['structure_index'],
+                                                               worker_state['postprocessor'], args,
+                                                               worker_state['spool_dir'])
+    return fname, match_spool, word_counts, num_words
+
 class Pipeline:
     def __init__(self, structures, **kwargs):
         kwargs['structures'] = structures
@@ -28,12 +43,13 @@ class Pipeline:
 
         self.structures, self.max_num_components, is_ud = build_structures(self.args)
         self.args['is_ud'] = is_ud
+        self.structure_index = StructureIndex(self.structures, is_ud)
 
         if self.args['lookup_api'] and not is_ud:
             self.lookup_api = LookupApi('https://blisk.ijs.si/api')
             self.lookup_lexicon = None
         elif self.args['lookup_lexicon'] is not None and os.path.exists(self.args['lookup_lexicon']) and not is_ud:
-            self.lookup_lexicon = LookupLexicon(self.args['lookup_lexicon'])
+            self.lookup_lexicon = load_lookup_lexicon(self.args['lookup_lexicon'])
             self.lookup_api = None
         else:
             self.lookup_lexicon = None
@@ -51,41 +67,80 @@ class Pipeline:
         self.args['corpus'] = corpus
         time_info = TimeInfo(len(self.args['corpus']))
 
-        database = Database(self.args)
-        self.match_store = MatchStore(self.args, database)
-        self.word_stats = WordStats(self.args, database)
-        postprocessor = Postprocessor(fixed_restriction_order=self.args['fixed_restriction_order'], lang=self.args['lang'])
+        if self.args['storage'] == 'memory':
+            storage = MemoryStorage(self.args)
+        elif self.args['storage'] == 'sqlite':
+            storage = SQLiteStorage(self.args)
+        elif self.args['storage'] == 'sharded':
+            storage = ShardedStorage(self.args)
+        else:
+            raise ValueError(f'Unknown storage: {self.args["storage"]} (it should be "sqlite", "sharded" or "memory").')
+        self.match_store = MatchStore(self.args, storage)
+        self.word_stats = WordStats(self.args, storage)
+        postprocessor = Postprocessor(fixed_restriction_order=self.args['fixed_restriction_order'],
+                                      lang=self.args['lang'])
+
+        if self.args['workers'] > 1:
+            self.extract_parallel(storage, time_info)
+        else:
+            self.extract(storage, postprocessor, time_info)
+        storage.loading_done()
 
-        for words in load_files(self.args, database):
-            if words is None:
-                time_info.add_measurement(-1)
-                continue
+        # get word renders for lemma/msd
+        self.word_stats.lowercase_words_under_threshold()
+        self.word_stats.generate_renders()
+        self.word_stats.load_index(self.args['word_index_memory'])
+        self.match_store.determine_collocation_dispersions()
 
+        # figure out representations!
+        self.match_store.set_representations(self.word_stats, self.structures, self.args['is_ud'], lookup_lexicon=self.lookup_lexicon, lookup_api=self.lookup_api)
+
+        return self
+
+    def extract(self, storage, postprocessor, time_info):
+        """ Loads and matches corpus files one by one. """
+        for chunks in load_files(self.args, storage):
             start_time = time.time()
-            matches = self.match_file(words, self.structures, postprocessor)
+            match_spool, word_counts, num_words = self.match_chunks(chunks, self.structure_index, postprocessor,
+                                                                    self.args)
 
-            # adds results to database
-            self.match_store.add_matches(matches)
-            self.word_stats.add_words(words)
-            database.commit()
+            # adds results to storage
+            with match_spool:
+                self.match_store.add_match_rows(match_spool.rows())
+            self.word_stats.add_word_counts(word_counts, num_words)
 
             # force a bit of garbage collection
-            del words
-            del matches
+            del chunks
+            del match_spool
+            del word_counts
             gc.collect()
 
             time_info.add_measurement(time.time() - start_time)
             time_info.info()
 
-        # get word renders for lemma/msd
-        self.word_stats.lowercase_words_under_threshold()
-        self.word_stats.generate_renders()
-        self.match_store.determine_collocation_dispersions()
+    def extract_parallel(self, storage, time_info):
+        """ Loads and matches corpus files in multiple processes. Results are stored in the same order as in
+        `extract`, so outputs are equal. Temporary files of matches are kept in a directory, that is removed at the
+        end, so that files of results, which were not read (ie. after an error), are removed too. """
+        filenames = list_files(self.args, storage)
+        postprocessor = Postprocessor(fixed_restriction_order=self.args['fixed_restriction_order'],
+                                      lang=self.args['lang'])
+        with tempfile.TemporaryDirectory(prefix='cordex-') as spool_dir:
+            state = {'args': self.args, 'structure_index': self.structure_index, 'postprocessor': postprocessor,
+                     'spool_dir': spool_dir}
+            with closing(ordered_imap(_process_file, ((fname,) for fname in filenames), self.args['workers'],
+                                      state)) as results:
+                start_time = time.time()
+                for fname, match_spool, word_counts, num_words in results:
+                    # adds results to storage
+                    with match_spool:
+                        self.match_store.add_match_rows(match_spool.rows())
+                    self.word_stats.add_word_counts(word_counts, num_words)
+                    mark_file_loaded(storage, fname)
 
-        # figure out representations!
-        self.match_store.set_representations(self.word_stats, self.structures, self.args['is_ud'], lookup_lexicon=self.lookup_lexicon, lookup_api=self.lookup_api)
-
-        return self
+                    time_info.add_measurement(time.time() - start_time)
+                    time_info.info()
+                    start_time = time.time()
 
     def write(self, path, separator='\t', sort_by=-1, sort_reversed=False, decimal_separator='.'):
         self.args['out'] = path
@@ -126,22 +181,54 @@ class Pipeline:
         return writer.write_out(self.structures, self.match_store, return_list=True)
 
     @staticmethod
-    def match_file(words, structures, postprocessor):
+    def match_chunks(chunks, structure_index, postprocessor, args, spool_dir=None):
+        """ Looks for collocations inside chunks of a file and returns results in a compact form. Matches are ordered
+        as if the whole file was matched at once. When file is read in chunks, matches of every chunk are moved to
+        temporary file in `spool_dir` (see `MatchSpool`), which should be closed after use. """
+        structures = structure_index.structures
+        chunked = args['chunk_size'] is not None
+        match_spool = MatchSpool(len(structures), on_disk=chunked, directory=spool_dir)
+        word_counts = Counter()
+        num_words = 0
+
+        if chunked:
+            chunks = progress(chunks, "matching-chunks")
+
+        try:
+            for words in chunks:
+                matches = Pipeline.match_file(words, structure_index, postprocessor, show_progress=not chunked)
+                match_spool.add([MatchStore.match_rows({s: matches[s]}, args['is_ud']) for s in structures])
+                word_counts.update(WordStats.count_words(words, args['is_ud']))
+                num_words += len(words)
+        except BaseException:
+            match_spool.close()
+            raise
+
+        return match_spool, word_counts, num_words
+
+    @staticmethod
+    def match_file(words, structure_index, postprocessor, show_progress=True):
         """ Looks for collocations inside a file that match structure restrictions. """
-        matches = {s: [] for s in structures}
+        structures = structure_index.structures
+
+        # words are only matched against structures, whose root restrictions they might satisfy
+        found = {s: [] for s in structures}
+        for w in progress(words, "matching") if show_progress else words:
+            for s in structure_index.candidates(w):
+                found[s].extend(s.match(w))
 
-        for s in progress(structures, "matching"):
-            for w in words:
-                mhere = s.match(w)
-                for match in mhere:
-                    if not postprocessor.is_fixed_restriction_order(match):
-                        continue
-                    collocation_id = [[idx, w.lemma] for idx, w in match.items()]
-                    collocation_id = [s.id] + list(sorted(collocation_id, key=lambda x: x[0]))
-                    match, collocation_id = postprocessor.process(match, collocation_id)
-                    collocation_id = tuple(collocation_id)
+        # postprocessing is done structure by structure, as it modifies words
+        matches = {s: [] for s in structures}
+        for s in structures:
+            for match in found[s]:
+                if not postprocessor.is_fixed_restriction_order(match):
+                    continue
+                collocation_id = [[idx, w.lemma] for idx, w in match.items()]
+                collocation_id = [s.id] + list(sorted(collocation_id, key=lambda x: x[0]))
+                match, collocation_id = postprocessor.process(match, collocation_id)
+                collocation_id = tuple(collocation_id)
 
-                    matches[s].append((match, collocation_id))
+                matches[s].append((match, collocation_id))
 
         return matches
 
@@ -161,7 +248,15 @@ class Pipeline:
             'statistics': True,
             'lang': 'sl',
             'collocation_sentence_map_dest': None,
-            'jos_depparse_lang': 'sl'
+            'jos_depparse_lang': 'sl',
+            'workers': 1,
+            'chunk_size': None,
+            'compact_words': False,
+            'word_index_memory': 256,
+            'db_profile': 'safe',
+            'db_pragmas': None,
+            'storage': 'sqlite',
+            'shards': 4
         }
 
         return {**default_args, **kwargs}
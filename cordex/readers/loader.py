@@ -4,20 +4,18 @@ Corpus loaders.
 import os
 from xml.etree import ElementTree
 import logging
-import re
-import sys
 import pathlib
-from io import StringIO
+import re
 import conllu
 from conversion_utils.jos_msds_and_properties import Converter
 
 from cordex.utils.converter import translate_jos_depparse
-from cordex.utils.progress_bar import progress
 from cordex.words.word import WordUD, WordJOS
+from cordex.words.compact import StringTable, FeatsTable, CompactSentences
 
 
-def load_files(args, database):
-    """ Loads corpora in various formats. """
+def list_files(args, storage):
+    """ Lists corpus files that are not yet stored. """
     filenames = args['corpus']
 
     if len(filenames) == 1 and os.path.isdir(filenames[0]):
@@ -32,35 +30,94 @@ def load_files(args, database):
         filenames = [filename for filename in filenames if filename[-5:] != '.zstd']
         filenames = sorted(filenames)
 
-    database.init("CREATE TABLE Files ( filename varchar(2048) )")
-
-    for idx, fname in enumerate(filenames):
-        logging.info("FILE " + fname + "{}/{}".format(idx, len(filenames)))
-        extension = pathlib.Path(fname).suffix
-
+    result = []
+    for fname in filenames:
         # check if file with the same name already loaded...
-        loaded = database.execute("SELECT * FROM Files WHERE filename=?", (fname,)).fetchone()
-        if loaded is not None:
-            logging.info("ALREADY LOADED")
+        if storage.is_file_loaded(fname):
+            logging.info("ALREADY LOADED " + fname)
             continue
+        result.append(fname)
 
-        if extension == ".xml":
-            et = load_tei(fname)
-            yield tei_sentence_generator(et, args)
-        elif extension == ".conllu" or extension == ".conllup":
-            yield load_conllu(fname, args)
-        else:
-            raise Exception(f'File {fname} is in incorrect format (it should be .xml, .conllu or .conllup).')
+    return result
+
+
+def load_file(fname, args):
+    """ Loads a single corpus file and returns its words in chunks of `chunk_size` sentences. When `chunk_size` is
+    None, all words of a file are returned in a single chunk. """
+    extension = pathlib.Path(fname).suffix
+
+    if extension == ".xml":
+        return tei_sentence_generator(fname, args, args['chunk_size'])
+    elif extension == ".conllu" or extension == ".conllup":
+        return conllu_sentence_generator(fname, args, args['chunk_size'])
+    else:
+        raise Exception(f'File {fname} is in incorrect format (it should be .xml, .conllu or .conllup).')
+
+
+def mark_file_loaded(storage, fname):
+    """ Stores information that file is processed. File is committed together with its results. """
+    storage.file_loaded(fname)
 
-        database.execute("INSERT INTO Files (filename) VALUES (?)", (fname,))
-        database.commit()
+
+def load_files(args, storage):
+    """ Loads corpora in various formats. """
+    filenames = list_files(args, storage)
+
+    for idx, fname in enumerate(filenames):
+        logging.info("FILE " + fname + "{}/{}".format(idx, len(filenames)))
+        yield load_file(fname, args)
+        mark_file_loaded(storage, fname)
 
 
 def load_conllu(filename, args):
     """ Loads corpus file in conllu format. """
+    result = []
+    for words in conllu_sentence_generator(filename, args):
+        result.extend(words)
+    return result
+
+
+def load_tei(filename):
+    """ Loads whole corpus file in TEI format as xml element without namespaces. Corpus files are read incrementally by
+    `tei_sentence_generator`, this is kept for loading whole files. """
+    with open(filename, 'r') as fp:
+        content = fp.read()
+
+    xmlstring = re.sub(' xmlns="[^"]+"', '', content, count=1)
+    xmlstring = xmlstring.replace(' xml:', ' ')
+    return ElementTree.XML(xmlstring)
+
+
+class CompactWords:
+    """ Replaces words of loaded sentences with compact words, when `compact_words` argument is set. Strings are
+    shared within a file, while each chunk gets its own columns, so that they are freed together with the chunk. """
+    def __init__(self, args):
+        self.enabled = args['compact_words']
+        if self.enabled:
+            self.strings = StringTable()
+            self.msds = FeatsTable() if args['is_ud'] else self.strings
+            self.new_chunk()
+
+    def new_chunk(self):
+        """ Starts storing words in new columns. """
+        if self.enabled:
+            self.sentences = CompactSentences(self.strings, self.msds)
+
+    def __call__(self, words):
+        if not self.enabled:
+            return words
+        return self.sentences.add_sentence(words)
+
+
+def conllu_sentence_generator(filename, args, chunk_size=None):
+    """ Generates words from corpus file in conllu format in chunks of `chunk_size` sentences. File is read
+    incrementally, so memory usage depends on chunk size and not on file size. """
     if args['jos_msd_lang'] == 'sl':
         raise NotImplementedError('jos_msd_lang == "sl" is not implemented for conllu data!')
     result = []
+    num_sentences = 0
+    num_chunks = 0
+    compact = CompactWords(args)
 
     words = {}
     links = []
@@ -74,12 +131,10 @@ def load_conllu(filename, args):
                 logging.warning("Bad link in sentence: " + sent_id)
                 continue
             words[lfrom].add_link(ana, words[ldest])
-        result.extend(words.values())
+        result.extend(compact(list(words.values())))
 
     with open(filename, 'r', encoding="UTF-8") as f:
-        data = f.read()
-
-        conlls = conllu.parse_incr(StringIO(data))
+        conlls = conllu.parse_incr(f)
         # build dep parse
         for sent in conlls:
             try:
@@ -115,95 +170,153 @@ def load_conllu(filename, args):
                 words = {}
                 logging.error(f"Error while reading file {filename} in sentence {sent.metadata['sent_id']}. Check if required data is available!")
 
-    return result
+            num_sentences += 1
+            if chunk_size is not None and num_sentences >= chunk_size:
+                yield result
+                result = []
+                num_sentences = 0
+                num_chunks += 1
+                compact.new_chunk()
 
+    if result or num_chunks == 0:
+        yield result
 
-def load_tei(filename):
-    """ Loads corpus file in TEI format. """
-    with open(filename, 'r') as fp:
-        content = fp.read()
 
-    xmlstring = re.sub(' xmlns="[^"]+"', '', content, count=1)
-    xmlstring = xmlstring.replace(' xml:', ' ')
-    return ElementTree.XML(xmlstring)
+def local_name(name):
+    """ Removes namespace from tag or attribute name. """
+    return name[name.index('}') + 1:] if name[0] == '{' else name
 
 
-def tei_sentence_generator(et, args):
-    """ Generates sentences from TEI format. """
+def strip_namespaces(element):
+    """ Removes namespaces from tags and attributes of element and its descendants (ie. `xml:id` becomes `id`). """
+    for el in element.iter():
+        el.tag = local_name(el.tag)
+        if any(k[0] == '{' for k in el.attrib):
+            el.attrib = {local_name(k): v for k, v in el.attrib.items()}
+
+
+def tei_sentence_generator(filename, args, chunk_size=None):
+    """ Generates words from corpus file in TEI format in chunks of `chunk_size` sentences. File is parsed
+    incrementally and elements are discarded as soon as they are processed, so memory usage depends on chunk size and
+    not on file size. Links between sentences are only kept within a chunk (or within the whole file, when it is not
+    read in chunks), so words are made compact once their chunk is read. """
     do_msd_translate = not args['jos_msd_lang'] == 'en'
     do_msd_translate = Converter() if do_msd_translate else False
 
-    words = {}
-    teis = list(et.iter('{http://www.tei-c.org/ns/1.0}TEI'))
-
-    ns = '{http://www.tei-c.org/ns/1.0}' if len(teis) != 0 else ''
+    result = []
+    num_sentences = 0
+    num_chunks = 0
+    compact = CompactWords(args)
+    # words of the file (or of the current chunk) by ids
+    known_words = {}
+
+    # open elements and number of open paragraphs and sentences
+    stack = []
+    p_depth = 0
+    s_depth = 0
+
+    for event, element in ElementTree.iterparse(filename, events=('start', 'end')):
+        tag = local_name(element.tag)
+        if event == 'start':
+            stack.append(element)
+            if tag == 'p':
+                p_depth += 1
+            elif tag == 's':
+                s_depth += 1
+            continue
 
-    # if not TEI element search for paragraphs only
-    teis = [et] if len(teis) == 0 else teis
+        stack.pop()
+        if tag == 'p':
+            p_depth -= 1
+        elif tag == 's':
+            s_depth -= 1
+            # only sentences inside paragraphs are processed
+            if p_depth > 0:
+                strip_namespaces(element)
+                result.extend(tei_sentence_words(element, args, do_msd_translate, known_words))
+
+                num_sentences += 1
+                if chunk_size is not None and num_sentences >= chunk_size:
+                    yield compact(result)
+                    result = []
+                    known_words = {}
+                    num_sentences = 0
+                    num_chunks += 1
+                    compact.new_chunk()
+
+        # discard processed elements, except those that are part of a sentence that is still being read
+        if s_depth == 0 and stack:
+            stack[-1].remove(element)
+
+    if result or num_chunks == 0:
+        yield compact(result)
+
+
+def tei_sentence_words(sentence, args, do_msd_translate, known_words):
+    """ Creates words from TEI sentence element. Links may also point to words of previous sentences in `known_words`
+    (words by ids), to which words of sentence are added. """
+    words = {}
 
-    for tei in teis:
-        paragraphs = list(tei.iter(ns + 'p'))
-        for paragraph in progress(paragraphs, "load-text"):
-            sentences = list(paragraph.iter(ns + 's'))
-            for sentence in sentences:
-                # create fake root word
-                if args['is_ud']:
-                    word = WordUD.fake_root_word(sentence.get('id'))
-                else:
-                    word = WordJOS.fake_root_word(sentence.get('id'))
-                words[sentence.get('id')] = word
-                previous_word = word
-
-                for w in sentence.iter():
-                    if w.tag == ns + 'w':
-                        if args['is_ud']:
-                            word = WordUD.from_tei_element(w, do_msd_translate)
-                        else:
-                            word = WordJOS.from_tei_element(w, do_msd_translate)
-
-                        word.previous_glue = previous_word.glue
-                        words[w.get('id')] = word
-                        previous_word = word
-
-                    elif w.tag == ns + 'pc':
-                        if args['is_ud']:
-                            word = WordUD.pc_word(w, do_msd_translate)
-                        else:
-                            word = WordJOS.pc_word(w, do_msd_translate)
-
-                        word.previous_glue = previous_word.glue
-                        words[w.get('id')] = word
-                        previous_word = word
-
-                for l in sentence.iter(ns + "link"):
-                    if 'dep' in l.keys():
-                        ana = l.get('afun')
-                        lfrom = l.get('from')
-                        dest = l.get('dep')
-                    else:
-                        ana = l.get('ana')
-                        if args['is_ud']:
-                            if ana[:7] != 'ud-syn:':  # dont bother...
-                                continue
-                            ana = ana[7:]
-                            lfrom, dest = l.get('target').replace('#', '').split()
-                        else:
-                            if ana[:8] != 'jos-syn:':  # dont bother...
-                                continue
-                            ana = ana[8:]
-                            lfrom, dest = l.get('target').replace('#', '').split()
-
-                    if lfrom in words:
-                        if dest in words:
-                            next_word = words[dest]
-                            translated_ana = translate_jos_depparse(ana, args['jos_depparse_lang'] != 'sl')
-                            words[lfrom].add_link(translated_ana, next_word)
-                        else:
-                            logging.error("Unknown id: {}".format(dest))
-                            sys.exit(1)
+    # create fake root word
+    if args['is_ud']:
+        word = WordUD.fake_root_word(sentence.get('id'))
+    else:
+        word = WordJOS.fake_root_word(sentence.get('id'))
+    words[sentence.get('id')] = word
+    previous_word = word
+
+    for w in sentence.iter():
+        if w.tag == 'w':
+            if args['is_ud']:
+                word = WordUD.from_tei_element(w, do_msd_translate)
+            else:
+                word = WordJOS.from_tei_element(w, do_msd_translate)
+
+            word.previous_glue = previous_word.glue
+            words[w.get('id')] = word
+            previous_word = word
+
+        elif w.tag == 'pc':
+            if args['is_ud']:
+                word = WordUD.pc_word(w, do_msd_translate)
+            else:
+                word = WordJOS.pc_word(w, do_msd_translate)
+
+            word.previous_glue = previous_word.glue
+            words[w.get('id')] = word
+            previous_word = word
+
+    known_words.update(words)
+
+    for l in sentence.iter("link"):
+        if 'dep' in l.keys():
+            ana = l.get('afun')
+            lfrom = l.get('from')
+            dest = l.get('dep')
+        else:
+            ana = l.get('ana')
+            if args['is_ud']:
+                if ana[:7] != 'ud-syn:':  # dont bother...
+                    continue
+                ana = ana[7:]
+                lfrom, dest = l.get('target').replace('#', '').split()
+            else:
+                if ana[:8] != 'jos-syn:':  # dont bother...
+                    continue
+                ana = ana[8:]
+                lfrom, dest = l.get('target').replace('#', '').split()
+
+        if lfrom in known_words:
+            if dest in known_words:
+                next_word = known_words[dest]
+                translated_ana = translate_jos_depparse(ana, args['jos_depparse_lang'] != 'sl')
+                known_words[lfrom].add_link(translated_ana, next_word)
+            else:
+                # words of previous chunks are no longer known, so links to them are skipped
+                logging.warning("Unknown id: {} (linked from {} in sentence {})".format(dest, lfrom, sentence.get('id')))
 
-                    else:
-                        # strange errors, just skip...
-                        pass
+        else:
+            # strange errors, just skip...
+            pass
 
     return list(words.values())
@@ -3,7 +3,13 @@ Connections to lexicon via API or file reading
 """
 import logging
 import lzma
+import mmap
+import os
 import pickle
+import struct
+import threading
+from functools import lru_cache
+
 import requests
 from cordex.utils.codes_tagset import TAGSET, CODES
 from cordex.utils.converter import msd_to_properties, default_msd_to_properties
@@ -11,6 +17,22 @@ from cordex.utils.progress_bar import progress
 
 SUPPORTED_LOOKUP_LANGUAGES = ['sl']
 
+# indexed lookup lexicon file consists of header (magic, version, number of lemmas), index of lemmas sorted by their
+# utf-8 encoding and data, where every index entry holds offsets and lengths of lemma and of its pickled forms
+INDEXED_LEXICON_MAGIC = b'CDXLEXI\0'
+INDEXED_LEXICON_VERSION = 1
+INDEXED_LEXICON_HEADER = struct.Struct('<8sII')
+INDEXED_LEXICON_ENTRY = struct.Struct('<QIQI')
+# number of recently used lemmas, whose forms are kept unpickled
+INDEXED_LEXICON_CACHE_SIZE = 1024
+# number of recently used lemmas, whose forms are indexed by features, and of recent results of `get_word_form`
+FORMS_INDEX_CACHE_SIZE = 1024
+WORD_FORM_CACHE_SIZE = 65536
+
+# lookup lexicons loaded in this process by (path, modification time), see `load_lookup_lexicon`
+_loaded_lexicons = {}
+_loaded_lexicons_lock = threading.Lock()
+
 class LookupApi:
     """ A class for managing API calls. """
     def __init__(self, base_url):
@@ -81,12 +103,12 @@ class LookupApi:
                 return form
         return None
 
-    def execute_requests(self, num_representations, db, all_representations):
+    def execute_requests(self, num_representations, storage, all_representations):
         """ Creates and executes queries on API from fake representations. """
         post_request = []
         i = 0
         # get data for lexeme post
-        for cid, sid in progress(db.execute("SELECT collocation_id, structure_id FROM Collocations"),
+        for cid, sid in progress(storage.collocations(),
                                  "representations-gather-lexeme", total=num_representations):
 
             representations = all_representations[i]
@@ -158,19 +180,146 @@ class LookupApi:
 
         return forms_data
 
+
+def write_indexed_lexicon(lexicon, file_path):
+    """ Writes lexicon (dictionary of lemmas and their lists of forms) in indexed format. """
+    lemmas = sorted((lemma.encode('utf-8'), lemma) for lemma in lexicon)
+    data_offset = INDEXED_LEXICON_HEADER.size + len(lemmas) * INDEXED_LEXICON_ENTRY.size
+
+    index = []
+    data = []
+    for encoded_lemma, lemma in lemmas:
+        forms = pickle.dumps(lexicon[lemma], protocol=pickle.HIGHEST_PROTOCOL)
+        index.append(INDEXED_LEXICON_ENTRY.pack(data_offset, len(encoded_lemma),
+                                                data_offset + len(encoded_lemma), len(forms)))
+        data.append(encoded_lemma)
+        data.append(forms)
+        data_offset += len(encoded_lemma) + len(forms)
+
+    with open(file_path, 'wb') as f:
+        f.write(INDEXED_LEXICON_HEADER.pack(INDEXED_LEXICON_MAGIC, INDEXED_LEXICON_VERSION, len(lemmas)))
+        f.writelines(index)
+        f.writelines(data)
+
+
+def is_indexed_lexicon(file_path):
+    """ Checks whether lexicon file is in indexed format. """
+    with open(file_path, 'rb') as f:
+        return f.read(len(INDEXED_LEXICON_MAGIC)) == INDEXED_LEXICON_MAGIC
+
+
+class IndexedLexicon:
+    """ Read-only dictionary of lemmas and their forms in memory-mapped indexed lexicon file. Lemmas are found with
+    binary search over index and only forms of requested lemmas are unpickled (forms of recently used lemmas are kept
+    for later requests). """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.num_lemmas = INDEXED_LEXICON_HEADER.unpack_from(self.data)
+        if magic != INDEXED_LEXICON_MAGIC or version != INDEXED_LEXICON_VERSION:
+            raise ValueError(f'{file_path} is not indexed lookup lexicon of version {INDEXED_LEXICON_VERSION}.')
+        self.forms = lru_cache(maxsize=INDEXED_LEXICON_CACHE_SIZE)(self.read_forms)
+
+    def __getstate__(self):
+        # memory map cannot be pickled, so it is opened again when unpickling
+        return self.file_path
+
+    def __setstate__(self, file_path):
+        self.__init__(file_path)
+
+    def __len__(self):
+        return self.num_lemmas
+
+    def entry(self, i):
+        """ Returns (lemma_offset, lemma_length, forms_offset, forms_length) at position `i` of index. """
+        return INDEXED_LEXICON_ENTRY.unpack_from(self.data, INDEXED_LEXICON_HEADER.size + i * INDEXED_LEXICON_ENTRY.size)
+
+    def find(self, lemma):
+        """ Returns position of lemma in index or None when lemma is not in lexicon. """
+        if lemma is None:
+            return None
+        encoded_lemma = lemma.encode('utf-8')
+        low, high = 0, self.num_lemmas
+        while low < high:
+            middle = (low + high) // 2
+            lemma_offset, lemma_length, _forms_offset, _forms_length = self.entry(middle)
+            middle_lemma = self.data[lemma_offset:lemma_offset + lemma_length]
+            if middle_lemma == encoded_lemma:
+                return middle
+            if middle_lemma < encoded_lemma:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def read_forms(self, lemma):
+        """ Reads forms of lemma or returns None when lemma is not in lexicon. """
+        i = self.find(lemma)
+        if i is None:
+            return None
+        _lemma_offset, _lemma_length, forms_offset, forms_length = self.entry(i)
+        return pickle.loads(self.data[forms_offset:forms_offset + forms_length])
+
+    def get(self, lemma, default=None):
+        """ Returns forms of lemma or `default` when lemma is not in lexicon. """
+        forms = self.forms(lemma)
+        return default if forms is None else forms
+
+    def __getitem__(self, lemma):
+        forms = self.get(lemma)
+        if forms is None:
+            raise KeyError(lemma)
+        return forms
+
+    def __contains__(self, lemma):
+        return self.get(lemma) is not None
+
+
 class LookupLexicon:
     """ Object that access lookup lexicon file. """
     def __init__(self, file_path=''):
+        self.file_path = file_path
         self.file_data = None
+        self.init_caches()
         self.init_file_reading(file_path)
 
+    def init_caches(self):
+        """ Creates caches of indexes of forms by features (see `create_forms_index`) of recently used lemmas and of
+        recent results of `get_word_form`. """
+        self.index_forms = lru_cache(maxsize=FORMS_INDEX_CACHE_SIZE)(self.create_forms_index)
+        self.cached_word_form = lru_cache(maxsize=WORD_FORM_CACHE_SIZE)(self.find_word_form)
+
+    def __getstate__(self):
+        # caches cannot be pickled, so they are created again when unpickling
+        state = self.__dict__.copy()
+        del state['index_forms']
+        del state['cached_word_form']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_caches()
+
     def init_file_reading(self, file_path):
-        """ Loads lookup lexicon file into memory. """
+        """ Opens indexed lookup lexicon file or loads compressed lookup lexicon file into memory. """
+        if is_indexed_lexicon(file_path):
+            self.file_data = IndexedLexicon(file_path)
+            return
+
         with lzma.open(file_path, "rb") as f:
             self.file_data = pickle.load(f)
 
     def get_word_form(self, lemma, msd, data, align_msd=False, find_lemma_msd=False, align_lemma=None):
-        """ Returns word form from lemma, msd restrictions and/or alignment msd. """
+        """ Returns word form from lemma, msd restrictions and/or alignment msd. Recent results are memoized. """
+        return self.cached_word_form(lemma, tuple(data['msd'].items()) if 'msd' in data else None,
+                                     tuple(data['agreement']) if 'agreement' in data else None, align_msd,
+                                     find_lemma_msd, align_lemma)
+
+    def find_word_form(self, lemma, msd_restrictions, agreements, align_msd, find_lemma_msd, align_lemma):
+        """ Finds word form from lemma, msd restrictions and/or alignment msd. Restrictions and agreements are given as
+        tuples, so that results may be memoized. """
         # handles cases when we are searching msds of lemmas
         if lemma in self.file_data and find_lemma_msd:
             for (word_form_features, form_representations, xpos, form_frequency) in self.file_data[lemma]:
@@ -179,15 +328,15 @@ class LookupLexicon:
 
         # modify msd as required
         form_features = {}
-        if 'msd' in data:
-            form_features = {k.lower(): v.lower() for k, v in data['msd'].items()}
+        if msd_restrictions is not None:
+            form_features = {k.lower(): v.lower() for k, v in msd_restrictions}
 
-        if align_msd and 'agreement' in data:
+        if align_msd and agreements is not None:
             # get agreement feature properties
             agreement_properties = default_msd_to_properties(align_msd, 'en', align_lemma)
 
             missing_form_features = False
-            for agreement_name in data['agreement']:
+            for agreement_name in agreements:
                 if agreement_name in agreement_properties.form_feature_map:
                     form_features[agreement_name] = agreement_properties.form_feature_map[agreement_name]
                 elif agreement_name in agreement_properties.lexeme_feature_map:
@@ -201,13 +350,44 @@ class LookupLexicon:
                 return None, None, None
 
         if lemma in self.file_data:
-            for (word_form_features, form_representations, xpos, form_frequency) in self.file_data[lemma]:
-                fits = True
-                for d_m_attribute, d_m_value in form_features.items():
-                    if d_m_attribute not in word_form_features or d_m_value != word_form_features[d_m_attribute]:
-                        fits = False
-                        break
-                if fits:
-                    break
+            word_form_features, form_representations, xpos, form_frequency = self.find_form(lemma, form_features)
             return xpos, lemma, form_representations
         return None, None, None
+
+    def create_forms_index(self, lemma):
+        """ Creates index of forms of lemma, that maps every (feature, value) to bit mask of positions of forms with
+        it. """
+        forms_index = {}
+        for position, (word_form_features, _form_representations, _xpos, _form_frequency) \
+                in enumerate(self.file_data[lemma]):
+            for feature in word_form_features.items():
+                forms_index[feature] = forms_index.get(feature, 0) | (1 << position)
+        return forms_index
+
+    def find_form(self, lemma, form_features):
+        """ Returns the first (most frequent) form of lemma having all given features or the last one when no form
+        fits. """
+        forms = self.file_data[lemma]
+        forms_index = self.index_forms(lemma)
+        positions = (1 << len(forms)) - 1
+        for feature in form_features.items():
+            positions &= forms_index.get(feature, 0)
+            if not positions:
+                return forms[-1]
+        # position of the lowest set bit
+        return forms[(positions & -positions).bit_length() - 1]
+
+
+def load_lookup_lexicon(file_path):
+    """ Returns lookup lexicon from file. Lexicon is loaded once per process and shared by all pipelines, until file is
+    modified. Worker processes, forked after lexicon is loaded, inherit it without loading, while those started with
+    `spawn` or `forkserver` method load it again. """
+    file_path = os.path.abspath(file_path)
+    key = (file_path, os.path.getmtime(file_path))
+    with _loaded_lexicons_lock:
+        if key not in _loaded_lexicons:
+            # older versions of the same file are no longer needed
+            for loaded_key in [loaded_key for loaded_key in _loaded_lexicons if loaded_key[0] == file_path]:
+                del _loaded_lexicons[loaded_key]
+            _loaded_lexicons[key] = LookupLexicon(file_path)
+        return _loaded_lexicons[key]
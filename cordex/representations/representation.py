@@ -14,13 +14,12 @@ whereas combinations with selection="all" have so far not been needed, and hence
 """
 
 import logging
-from ast import literal_eval
 
 from collections import Counter
 
 from conversion_utils import jos_msds_and_properties
 
-from cordex.utils.converter import msd_to_properties, default_msd_to_properties
+from cordex.utils.converter import msd_to_properties, default_msd_to_properties, encode_udpos, decode_udpos
 from cordex.words.word import WordDummy
 
 
@@ -144,7 +143,7 @@ class WordFormAnyCR(ComponentRepresentation):
         words_counter = []
         for word in self.words:
             if is_ud:
-                words_counter.append((str(word.udpos), word.lemma))
+                words_counter.append((encode_udpos(word.udpos), word.lemma))
             else:
                 words_counter.append((word.xpos, word.lemma))
         words_counter_ordered = sorted(list(set(words_counter)),
@@ -241,20 +240,15 @@ class WordFormAnyCR(ComponentRepresentation):
                 for agr in self.agreement:
                     agr.confirm_match()
 
-                if is_ud:
-                    word_msd_eval = self.convert_dict_to_string(literal_eval(word_msd))
-                else:
-                    word_msd_eval = word_msd
-
                 text = self.word_renderer.render(word_lemma, word_msd)
 
                 if text:
-                    return self.word_renderer.render(word_lemma, word_msd), word_msd_eval
+                    return self.word_renderer.render(word_lemma, word_msd), word_msd
                 else:
                     if len(self.words) != 1:
                         raise ValueError('Internal database is not setup correctly! All msd - lemma combinations should be in UniqWords table. In this situation they are not.')
                     else:
-                        return self.words[0].text, word_msd_eval
+                        return self.words[0].text, word_msd
         return None, None
 
 
@@ -413,7 +407,7 @@ class WordFormAgreementCR(WordFormMsdCR):
     @staticmethod
     def check_agreement_udpos(msd1, msd2, agreements):
         """ Checks if msds match in agreements. """
-        msd1 = literal_eval(msd1)
+        msd1 = decode_udpos(msd1)
         for agr_case in agreements:
             agr_case = agr_case.capitalize()
 
@@ -72,15 +72,27 @@ class MorphologyRegex:
         assert 'POS' in restr_dict
         self.restrictions = restr_dict
 
+        # restriction names are lowercased once, as they are in properties
+        self.lowercased_restrictions = [(res_name.lower(), res_val) for res_name, res_val in restr_dict.items()]
+
+        # results of already checked msds (msd -> bool)
+        self.cache = {}
+
     def __call__(self, text, lemma):
+        result = self.cache.get(text)
+        if result is None:
+            result = self.match_msd(text)
+            self.cache[text] = result
+        return result
+
+    def match_msd(self, text):
+        """ Checks whether msd satisfies restrictions. Result only depends on msd, so it may be cached. """
         if not text:
             return False
 
-        properties = msd_to_properties(text, 'en', lemma)
-
-        for res_name, res_val in self.restrictions.items():
-            res_name = res_name.lower()
+        properties = msd_to_properties(text, 'en')
 
+        for res_name, res_val in self.lowercased_restrictions:
             # handles category
             if res_name == 'pos':
                 if properties['pos'] not in res_val[0]:
@@ -159,9 +171,10 @@ class LexisRegex:
 
         assert "lemma" in restr_dict
         self.match_list = restr_dict['lemma'].split('|')
+        self.match_set = set(self.match_list)
     
     def __call__(self, text, lemma):
-        return text in self.match_list
+        return text in self.match_set
 
 
 class SpaceRegex:
@@ -223,6 +236,18 @@ class Restriction:
         else:
             raise NotImplementedError()
 
+    def index_keys(self):
+        """ Returns keys (('pos', category) or ('lemma', lemma)) of words, that might satisfy restriction. None
+        indicates that any word might satisfy it. """
+        if self.type == RestrictionType.Morphology:
+            return [('pos', pos) for pos in self.matcher.restrictions['POS'][0]]
+        elif self.type == RestrictionType.MorphologyUD:
+            values, negate = self.matcher.restrictions['POS']
+            return None if negate else [('pos', pos) for pos in values]
+        elif self.type == RestrictionType.Lexis:
+            return [('lemma', lemma) for lemma in self.matcher.match_list]
+        return None
+
     def match(self, word):
         """ Obtains data necessary for matcher and runs it. """
         if self.type == RestrictionType.Morphology:
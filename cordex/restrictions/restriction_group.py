@@ -13,6 +13,22 @@ class RestrictionGroup:
         for restriction in self.restrictions:
             yield restriction
 
+    def index_keys(self):
+        """ Returns keys of words, that might satisfy restrictions (see `Restriction.index_keys`). """
+        if self.group_type == 'or':
+            keys = []
+            for restr in self.restrictions:
+                restr_keys = restr.index_keys()
+                if restr_keys is None:
+                    return None
+                keys.extend(restr_keys)
+            return keys
+
+        # all restrictions have to be satisfied, so keys of the most selective one suffice
+        all_keys = [restr_keys for restr_keys in (restr.index_keys() for restr in self.restrictions)
+                    if restr_keys is not None]
+        return min(all_keys, key=len) if all_keys else None
+
     def match(self, word):
         """ Checks whether sufficient restrictions are met. """
         if self.group_type == 'or':
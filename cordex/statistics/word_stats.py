@@ -1,170 +1,221 @@
 """
 A class for saving statistics.
 """
+import copy
 from collections import defaultdict, Counter
+from functools import lru_cache
 
-from ast import literal_eval
+from cordex.utils.converter import encode_udpos, decode_udpos
 
 from cordex.utils.progress_bar import progress
+from cordex.words.compact import StringTable
 import logging
 
+# estimated memory usage (in bytes) of a single row in in-memory index of words
+INDEX_ROW_SIZE = 200
+
 
 class WordStats:
-    def __init__(self, args, db):
-        self.db = db
+    def __init__(self, args, storage):
+        self.storage = storage
+        self.strings = storage.strings
         self.is_ud = args['is_ud']
         self.all_words = None
+        self.lemma_words = None
+        self.index = None
+        self.shared_snapshot = None
 
-        if self.is_ud:
-            self.db.init("""CREATE TABLE UniqWords (
-                uw_id INTEGER PRIMARY KEY, 
-                lemma varchar(64), 
-                udpos varchar(32), 
-                text varchar(64), 
-                frequency int
-                )""")
-            self.db.init("CREATE TABLE WordCountUPOS (lemma varchar(64), upos varchar(32), frequency int)")
-            self.db.init("CREATE INDEX lemma_msd_text_on_uw ON UniqWords (lemma, udpos, text)")
-            self.db.init("CREATE INDEX lemma_msd0_on_wc ON WordCountUPOS (lemma, upos)")
-        else:
-            self.db.init("""CREATE TABLE UniqWords (
-                            uw_id INTEGER PRIMARY KEY, 
-                            lemma varchar(64), 
-                            xpos varchar(16), 
-                            text varchar(64), 
-                            frequency int
-                            )""")
-            self.db.init("CREATE TABLE WordCountXPOS (lemma varchar(64), xpos0 char, frequency int)")
-            self.db.init("CREATE INDEX lemma_msd_text_on_uw ON UniqWords (lemma, xpos, text)")
-            self.db.init("CREATE INDEX lemma_msd0_on_wc ON WordCountXPOS (lemma, xpos0)")
-        self.db.init("CREATE TABLE NumWords (id INTEGER PRIMARY KEY, n INTEGER)")
-
-        self.db.init("CREATE INDEX lemma_on_uw ON UniqWords (lemma)")
+    @staticmethod
+    def count_words(words, is_ud):
+        """ Counts (lemma, msd, text) combinations of words. Returned counter is compact, so it may also be passed
+        between processes. """
+        return Counter((w.lemma, encode_udpos(w.udpos) if is_ud else str(w.xpos), w.text) for w in words if not w.fake_word)
 
     def add_words(self, words):
         """ Adds words to database. """
-        for w in progress(words, "adding-words"):
-            if w.fake_word:
-                continue
-            if self.is_ud:
-                params = {'lemma': w.lemma, 'udpos': str(w.udpos), 'text': w.text}
-                res = self.db.execute("""UPDATE UniqWords SET frequency=frequency + 1
-                    WHERE lemma=:lemma AND udpos=:udpos AND text=:text""", params)
-
-                if res.rowcount == 0:
-                    self.db.execute("""INSERT INTO UniqWords (lemma, udpos, text, frequency) 
-                        VALUES (:lemma, :udpos, :text, 1)""", params)
-            else:
-                params = {'lemma': w.lemma, 'xpos': str(w.xpos), 'text': w.text}
-                res = self.db.execute("""UPDATE UniqWords SET frequency=frequency + 1
-                                    WHERE lemma=:lemma AND xpos=:xpos AND text=:text""", params)
-
-                if res.rowcount == 0:
-                    self.db.execute("""INSERT INTO UniqWords (lemma, xpos, text, frequency) 
-                                        VALUES (:lemma, :xpos, :text, 1)""", params)
-
-        self.db.execute("INSERT INTO NumWords (n) VALUES (?)", (len(words),))
+        self.add_word_counts(WordStats.count_words(words, self.is_ud), len(words))
+
+    def add_word_counts(self, counts, num_words):
+        """ Adds counted words (see `count_words`) to storage. Lemmas, msds and texts are stored as ids of interned
+        strings. """
+        string_id = self.strings.get_id
+        counts = {(string_id(lemma), string_id(msd), string_id(text)): (freq, msd)
+                  for (lemma, msd, text), freq in counts.items()}
+        # upos is stored separately, so that words may be grouped by it
+        self.storage.add_word_counts(((key, (freq, string_id(decode_udpos(msd)['POS']) if self.is_ud else None))
+                                      for key, (freq, msd) in progress(counts.items(), "adding-words")), num_words)
 
     def lowercase_words_under_threshold(self):
         """ Lowercase words that have lowercased version that occur more than 10 % of times in corpus. """
         threshold = 0.1
-        all_data = self.db.execute("""SELECT * FROM UniqWords""")
-        for i, lemma, pos, text, freq in all_data:
-            if text[0].isupper():
-                if self.is_ud:
-                    lowercased_options = self.db.execute("""SELECT text, frequency FROM UniqWords WHERE lemma=? AND udpos=? AND text=?""", (lemma, pos, text.lower(),))
-                else:
-                    lowercased_options = self.db.execute(
-                        """SELECT text, frequency FROM UniqWords WHERE lemma=? AND xpos=? AND text=?""", (lemma, pos, text.lower(),))
-
-                for lc_text, lc_freq in lowercased_options:
-                    if freq >= lc_freq >= freq * threshold:
-                        if self.is_ud:
-                            self.db.execute(
-                                """UPDATE UniqWords SET text=? WHERE lemma=? AND udpos=? AND text=?""",
-                                (text.lower(), lemma, pos, text,))
-                        else:
-                            self.db.execute(
-                                """UPDATE UniqWords SET text=? WHERE lemma=? AND xpos=? AND text=?""",
-                                (text.lower(), lemma, pos, text,))
 
+        # only texts with uppercase first letter, whose lowercased version exists, may be lowercased
+        strings = self.strings
+        lowercased = {}
+        for text_id, text in enumerate(strings.values):
+            if type(text) == str and text and text[0].isupper():
+                lc_text_id = strings.ids.get(text.lower())
+                if lc_text_id is not None:
+                    lowercased[text_id] = lc_text_id
+        lowercased_ids = set(lowercased.values())
+
+        # frequencies of rows with the same (lemma, msd, text) and uppercase rows in order of ids
+        frequencies = defaultdict(list)
+        uppercase_rows = []
+        for uw_id, lemma, pos, text, freq in progress(self.storage.words(), "lowercase"):
+            if text in lowercased or text in lowercased_ids:
+                frequencies[(lemma, pos, text)].append((uw_id, freq))
+            if text in lowercased:
+                uppercase_rows.append((lemma, pos, text, freq))
+
+        # words are processed one by one, as lowercased words also become options for the following ones
+        updates = []
+        for lemma, pos, text, freq in uppercase_rows:
+            key = (lemma, pos, text)
+            if key not in frequencies:
+                # already lowercased
+                continue
+
+            lc_key = (lemma, pos, lowercased[text])
+            if any(freq >= lc_freq >= freq * threshold for _uw_id, lc_freq in frequencies[lc_key]):
+                rows = frequencies.pop(key)
+                frequencies[lc_key].extend(rows)
+                updates.extend((lc_key[2], uw_id) for uw_id, _freq in rows)
+
+        # lowercasing may create duplicate (lemma, msd, text) combinations
+        self.storage.update_word_texts(updates)
 
     def num_all_words(self):
         """ Counts all words. """
 
         if self.all_words is None:
-            cur = self.db.execute("SELECT sum(n) FROM NumWords")
-            self.all_words = int(cur.fetchone()[0])
+            self.all_words = self.storage.num_all_words()
         return self.all_words
 
     def generate_renders(self):
         """ Counts frequencies for lemma + msd combinations. """
         step_name = 'generate_renders'
-        if self.db.is_step_done(step_name):
+        if self.storage.is_step_done(step_name):
             logging.info("Skipping GenerateRenders, already complete")
             return
 
-        lemmas = [lemma for (lemma, ) in self.db.execute("SELECT DISTINCT lemma FROM UniqWords")]
-        for lemma in progress(lemmas, 'word-count'):
-            if self.is_ud:
-                num_words_upos = defaultdict(int)
-                for (udpos, freq) in self.db.execute("SELECT udpos, frequency FROM UniqWords WHERE lemma=?", (lemma,)):
-                    upos = literal_eval(udpos)['POS']
-                    num_words_upos[upos] += freq
+        self.storage.generate_word_counts()
 
-                for upos, freq in num_words_upos.items():
-                    self.db.execute("INSERT INTO WordCountUPOS (lemma, upos, frequency) VALUES (?,?,?)",
-                                    (lemma, upos, freq))
+        self.storage.step_is_done(step_name)
+
+    def load_index(self, memory_limit):
+        """ Prepares in-memory index of words for `render`, `available_words` and `num_words`. When all words fit into
+        `memory_limit` (in MB), the whole index is loaded at once, otherwise only words of recently used lemmas are
+        kept in memory. """
+        self.index = None
+        self.shared_snapshot = None
+        if not memory_limit:
+            self.lemma_words = None
+            return
 
-            else:
-                num_words_xpos = defaultdict(int)
-                for (xpos, freq) in self.db.execute("SELECT xpos, frequency FROM UniqWords WHERE lemma=?", (lemma,)):
-                    xpos0 = xpos[0]
-                    num_words_xpos[xpos0] += freq
+        num_rows, num_lemmas = self.storage.num_word_rows()
+        budget = memory_limit * 2 ** 20
 
-                for xpos0, freq in num_words_xpos.items():
-                    self.db.execute("INSERT INTO WordCountXPOS (lemma, xpos0, frequency) VALUES (?,?,?)",
-                                    (lemma, xpos0, freq))
+        if num_rows * INDEX_ROW_SIZE <= budget:
+            self.index = self.load_full_index(num_rows)
+            self.lemma_words = self.index_entry
+        else:
+            rows_per_lemma = num_rows / max(num_lemmas, 1)
+            cache_size = max(int(budget / (rows_per_lemma * INDEX_ROW_SIZE)), 1)
+            self.lemma_words = lru_cache(maxsize=cache_size)(self.query_lemma_words)
+
+    def load_full_index(self, num_rows):
+        """ Loads index entries (see `lemma_index_entry`) of all lemmas. """
+        words = defaultdict(list)
+        for lemma, msd, text, freq in progress(self.storage.all_words(), "word-index", total=num_rows):
+            words[lemma].append((msd, text, freq))
+        counts = defaultdict(list)
+        for lemma, msd0, freq in self.storage.all_word_counts():
+            counts[lemma].append((msd0, freq))
+
+        index = {lemma: self.lemma_index_entry(lemma_words, counts[lemma]) for lemma, lemma_words in words.items()}
+        return index, self.lemma_index_entry([], [])
+
+    def index_entry(self, lemma_id):
+        """ Returns index entry of lemma from the whole index. """
+        index, empty_entry = self.index
+        return index.get(lemma_id, empty_entry)
+
+    def snapshot(self):
+        """ Returns read-only copy with the whole index in memory, that does not need storage, so it may be passed to
+        other processes. Copy is created once and shared by all users. Returns None when the whole index is not loaded,
+        because it does not fit into `word_index_memory`. """
+        if self.index is None:
+            return None
 
-        self.db.step_is_done(step_name)
+        if self.shared_snapshot is None:
+            snapshot = copy.copy(self)
+            snapshot.storage = None
+            snapshot.strings = StringTable()
+            snapshot.strings.ids, snapshot.strings.values = self.strings.ids, self.strings.values
+            snapshot.all_words = self.num_all_words()
+            # bound to snapshot, so that original (and its storage) is not passed along with it
+            snapshot.lemma_words = snapshot.index_entry
+            self.shared_snapshot = snapshot
+        return self.shared_snapshot
+
+    def query_lemma_words(self, lemma_id):
+        """ Loads index entry (see `lemma_index_entry`) of a single lemma from storage. """
+        return self.lemma_index_entry(list(self.storage.lemma_words(lemma_id)),
+                                      list(self.storage.lemma_word_counts(lemma_id)))
+
+    def lemma_index_entry(self, words, counts):
+        """ Creates index entry of a lemma from its words (msd, text and frequency ids, in descending order of
+        frequencies) and counts. Entry consists of decoded words, renders (most frequent texts for msd ids) and
+        counts. """
+        strings = self.strings
+        decoded_words = []
+        renders = {}
+        for msd, text, freq in words:
+            decoded_words.append((decode_udpos(strings[msd]) if self.is_ud else strings[msd], strings[text]))
+
+            # among equally frequent words the alphabetically first one is chosen
+            render = renders.get(msd)
+            if render is None or (render[0] == freq and strings[text] < render[1]):
+                renders[msd] = (freq, strings[text])
+
+        return decoded_words, {msd: text for msd, (_freq, text) in renders.items()}, dict(reversed(counts))
 
     def render(self, lemma, msd):
         """ Returns most frequent word for specific lemma+msd pair. """
-        if self.is_ud:
-            statement = """SELECT text FROM UniqWords WHERE 
-                           lemma=:lemma AND udpos=:udpos ORDER BY frequency DESC"""
+        strings = self.strings
+        lemma_id, msd_id = strings.ids.get(lemma), strings.ids.get(msd)
+        if lemma_id is None or msd_id is None:
+            return None
 
-            cur = self.db.execute(statement, {"lemma": lemma, "udpos": msd})
-        else:
-            statement = """SELECT text FROM UniqWords WHERE 
-                        lemma=:lemma AND xpos=:xpos ORDER BY frequency DESC"""
+        if self.lemma_words is not None:
+            return self.lemma_words(lemma_id)[1].get(msd_id)
 
-            cur = self.db.execute(statement, {"lemma": lemma, "xpos": msd})
-        fetch = cur.fetchone()
-        if fetch is None:
+        # among equally frequent words the alphabetically first one is chosen
+        texts = [(-frequency, strings[text]) for text, frequency in self.storage.word_texts(lemma_id, msd_id)]
+        if not texts:
             return None
 
-        return fetch[0]
+        return min(texts)[1]
 
     def available_words(self, lemma):
         """ Lists possible words for agreements and lists them in descending order. """
-        if self.is_ud:
-            statement = """SELECT udpos, text, frequency FROM UniqWords WHERE 
-                        lemma=:lemma ORDER BY frequency DESC"""
-            for udpos, text, _f in self.db.execute(statement, {'lemma': lemma}):
-                yield literal_eval(udpos), text, lemma
-        else:
-            statement = """SELECT xpos, text, frequency FROM UniqWords WHERE 
-                        lemma=:lemma ORDER BY frequency DESC"""
-            for xpos, text, _f in self.db.execute(statement, {'lemma': lemma}):
-                yield xpos, text, lemma
+        strings = self.strings
+        lemma_id = strings.ids.get(lemma)
+        if lemma_id is None:
+            return
+
+        if self.lemma_words is not None:
+            for msd, text in self.lemma_words(lemma_id)[0]:
+                yield msd, text, lemma
+            return
+
+        for msd, text, _f in self.storage.lemma_words(lemma_id):
+            yield decode_udpos(strings[msd]) if self.is_ud else strings[msd], strings[text], lemma
 
     def num_words(self, lemma, msd0):
         """ Returns first word frequency when lemma and msd match. """
-        if self.is_ud:
-            statement = "SELECT frequency FROM WordCountUPOS WHERE lemma=? AND upos=? LIMIT 1"
-        else:
-            statement = "SELECT frequency FROM WordCountXPOS WHERE lemma=? AND xpos0=? LIMIT 1"
-        cur = self.db.execute(statement, (lemma, msd0))
-        result = cur.fetchone()[0]
-        return result
+        if self.lemma_words is not None:
+            return self.lemma_words(self.strings.ids.get(lemma))[2][msd0]
+
+        return self.storage.word_count(self.strings.ids.get(lemma), msd0)
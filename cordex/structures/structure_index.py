@@ -0,0 +1,61 @@
+"""
+Index of syntactic structures by restrictions of their root components.
+"""
+from collections import defaultdict
+
+from cordex.restrictions.restriction_group import RestrictionGroup
+from cordex.utils.converter import msd_category
+
+
+class StructureIndex:
+    """
+    Maps part of speech and lemma keys to structures, whose root component may match words with such keys. This way
+    each word is only matched against structures that could start with it.
+    """
+    def __init__(self, structures, is_ud):
+        self.structures = structures
+        self.is_ud = is_ud
+
+        self.order = {s: i for i, s in enumerate(structures)}
+        self.by_key = defaultdict(list)
+        self.any_word = []
+        for s in structures:
+            restrictions = s.components[0].restrictions
+            keys = restrictions.index_keys() if isinstance(restrictions, RestrictionGroup) else None
+            if keys is None:
+                self.any_word.append(s)
+                continue
+            for key in set(keys):
+                self.by_key[key].append(s)
+
+        self.pos_candidates = {}
+
+    def word_pos(self, word):
+        """ Returns part of speech key of a word. """
+        if self.is_ud:
+            if not word.udpos:
+                return None
+            return word.udpos.get('POS')
+
+        if not word.xpos:
+            return None
+        return msd_category(word.xpos)
+
+    def candidates(self, word):
+        """ Returns structures (in original order), whose root restrictions might match word. """
+        pos = self.word_pos(word)
+
+        # words with unknown msds are tested against everything
+        if pos is None and not self.is_ud and word.xpos:
+            return self.structures
+
+        structures = self.pos_candidates.get(pos)
+        if structures is None:
+            structures = sorted(self.any_word + self.by_key.get(('pos', pos), []), key=self.order.get)
+            self.pos_candidates[pos] = structures
+
+        lemma_structures = self.by_key.get(('lemma', word.lemma))
+        if lemma_structures:
+            structures = sorted(set(structures).union(lemma_structures), key=self.order.get)
+
+        return structures
@@ -1,6 +1,8 @@
 """
 Converter for msd translations and msd conversions to properties
 """
+from functools import lru_cache
+
 from conversion_utils.jos_msds_and_properties import Converter, Msd, Properties, LEVEL_EXCEPTIONS
 from conversion_utils.translate_conllu_jos import get_syn_map
 
@@ -14,6 +16,11 @@ class OptimizedConverter(object):
         self.properties = {category.codes.en.upper(): (category.names.en, [{value.codes.en: (feature.names.en, value.names.en) for value in feature.values} for feature in category.features]) for category in converter.specifications.categories}
         self.lemma_properties = {category.codes.en.upper(): (category.names.en, [{value.codes.en: (feature.names.en, value.names.en) for value in feature.values} for feature in category.features]) for category in converter.specifications.categories}
 
+    def category(self, msd):
+        """ Returns name of msd category or None when category is unknown. """
+        category = self.properties.get(msd[0])
+        return None if category is None else category[0]
+
     def msd_to_properties(self, msd, language, lemma=None, require_valid_flag=False, warn_level_flag=False):
         category_name, category_properties = self.properties[msd[0]]
 
@@ -31,10 +38,23 @@ class OptimizedConverter(object):
 
 optimized_converter = OptimizedConverter()
 
+# decoded properties of already seen msds (msd -> properties)
+properties_cache = {}
+
 def msd_to_properties(msd_text, lang, lemma=None):
-    """ Converts msd to properties using conversion_utils library. """
+    """ Converts msd to properties using conversion_utils library. Properties are cached and shared between calls, so
+    they should not be modified. """
     # msd_model = Msd(msd_text, lang)
-    return optimized_converter.msd_to_properties(msd_text, lang, lemma=lemma)
+    properties = properties_cache.get(msd_text)
+    if properties is None:
+        properties = optimized_converter.msd_to_properties(msd_text, lang, lemma=lemma)
+        properties_cache[msd_text] = properties
+    return properties
+
+
+def msd_category(msd_text):
+    """ Returns name of msd category (ie. 'noun'). """
+    return optimized_converter.category(msd_text)
 
 
 def default_msd_to_properties(msd, language, lemma=None, require_valid_flag=False, warn_level_flag=False):
@@ -56,3 +76,27 @@ def translate_jos_depparse(tag, translate_jos_depparse_to_sl):
     if tag not in syn_map:
         raise ValueError(f'Tag "{tag}" is not recognized as a valid English tag. You might be using Slovenian depparse system in which case set "jos_depparse_lang" to "sl".')
     return syn_map[tag]
+
+
+class FrozenFeats(dict):
+    """ Read-only dictionary of UD features. Decoded features are cached and shared between words, so they must not
+    be changed. """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('UD features are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+def encode_udpos(udpos):
+    """ Encodes UD features (udpos) into canonical string (ie. `POS=NOUN|Case=Nom`). Order of features is kept. """
+    if not udpos:
+        return ''
+    return '|'.join(f'{k}={v}' for k, v in udpos.items())
+
+
+@lru_cache(maxsize=65536)
+def decode_udpos(encoded_udpos):
+    """ Decodes UD features encoded with `encode_udpos`. """
+    if not encoded_udpos:
+        return ''
+    return FrozenFeats(feature.split('=', 1) for feature in encoded_udpos.split('|'))
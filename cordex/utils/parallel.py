@@ -0,0 +1,30 @@
+"""
+Processing of tasks in multiple processes.
+"""
+import multiprocessing
+from collections import deque
+
+# data of worker process, that is shared between all its tasks (see `ordered_imap`)
+worker_state = {}
+
+
+def _init_worker(state):
+    """ Prepares data, that is shared between all tasks processed in a worker process. """
+    worker_state.clear()
+    worker_state.update(state)
+
+
+def ordered_imap(function, tasks, workers, state):
+    """ Calls `function` with arguments of every task in `workers` processes and yields results in order of tasks.
+    Tasks are read in this process, as they may come from storage, which may only be used by a single thread, and only
+    a few tasks per worker wait at once, so that memory stays bounded. Data in `state` is passed to every worker once
+    and is available in `worker_state` (with `fork` start method it is inherited from this process). Workers are stopped
+    when all results are read or when generator is closed. """
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(state,)) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, task))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,179 @@
+"""
+Compact word model. Tokens of many sentences are stored column by column in arrays of interned ids and words are only
+thin views into these columns.
+"""
+
+from array import array
+
+# bits of token flags
+GLUE = 1
+PREVIOUS_GLUE = 2
+FAKE_WORD = 4
+
+
+class StringTable:
+    """ Assigns integer ids to strings, so that each distinct string is stored only once. """
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def get_id(self, value):
+        """ Returns id of value and adds value to table if it is not there yet. """
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self.ids[value] = value_id
+            self.values.append(value)
+        return value_id
+
+    def __getitem__(self, value_id):
+        return self.values[value_id]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class FeatsTable(StringTable):
+    """ Assigns integer ids to UD features (udpos), so that equal features are represented with one shared
+    dictionary. """
+    def get_id(self, feats):
+        """ Returns id of features and adds them to table if they are not there yet. """
+        key = tuple(feats.items()) if feats else ()
+        value_id = self.ids.get(key)
+        if value_id is None:
+            value_id = len(self.values)
+            self.ids[key] = value_id
+            self.values.append(feats)
+        return value_id
+
+
+class CompactSentences:
+    """
+    Column store of tokens of multiple sentences. Dependency links are stored as per token ranges of children (with
+    their deprels), which preserves the order in which links were added.
+    """
+    def __init__(self, strings, msds):
+        self.strings = strings
+        self.msds = msds
+
+        self.lemmas = array('l')
+        self.texts = array('l')
+        self.msd_ids = array('l')
+        self.word_ids = array('l')
+        self.sentence_ids = array('l')
+        self.int_ids = array('q')
+        self.flags = array('B')
+
+        self.child_offsets = array('l', [0])
+        self.children = array('l')
+        self.child_deprels = array('l')
+
+    def __len__(self):
+        return len(self.flags)
+
+    def add_sentence(self, words):
+        """ Stores words of one or more sentences (created by loaders) and returns compact words that replace them.
+        Linked words have to be among stored words. """
+        strings = self.strings
+        start = len(self)
+        positions = {id(word): start + i for i, word in enumerate(words)}
+
+        for word in words:
+            self.lemmas.append(strings.get_id(word.lemma))
+            self.texts.append(strings.get_id(word.text))
+            self.msd_ids.append(self.msds.get_id(word.udpos if hasattr(word, 'udpos') else word.xpos))
+            self.word_ids.append(strings.get_id(word.id))
+            self.sentence_ids.append(strings.get_id(word.sentence_id))
+            self.int_ids.append(word.int_id)
+            self.flags.append((GLUE if word.glue else 0) | (PREVIOUS_GLUE if word.previous_glue else 0) |
+                              (FAKE_WORD if word.fake_word else 0))
+
+            for deprel, linked_words in word.links.items():
+                deprel_id = strings.get_id(deprel)
+                for linked_word in linked_words:
+                    self.children.append(positions[id(linked_word)])
+                    self.child_deprels.append(deprel_id)
+            self.child_offsets.append(len(self.children))
+
+        return [CompactWord(self, i) for i in range(start, len(self))]
+
+
+class CompactWord:
+    """
+    View of a single token in `CompactSentences`. It offers the same attributes as `Word`, so it may be used in
+    matching instead of it.
+    """
+    __slots__ = ('sentences', 'index')
+
+    def __init__(self, sentences, index):
+        self.sentences = sentences
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactWord) and self.index == other.index and self.sentences is other.sentences
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return f'CompactWord({self.sentence_id}.{self.id}, {self.text!r})'
+
+    @property
+    def lemma(self):
+        return self.sentences.strings[self.sentences.lemmas[self.index]]
+
+    @property
+    def text(self):
+        return self.sentences.strings[self.sentences.texts[self.index]]
+
+    @text.setter
+    def text(self, value):
+        self.sentences.texts[self.index] = self.sentences.strings.get_id(value)
+
+    @property
+    def xpos(self):
+        return self.sentences.msds[self.sentences.msd_ids[self.index]]
+
+    @property
+    def udpos(self):
+        return self.sentences.msds[self.sentences.msd_ids[self.index]]
+
+    @property
+    def id(self):
+        return self.sentences.strings[self.sentences.word_ids[self.index]]
+
+    @property
+    def sentence_id(self):
+        return self.sentences.strings[self.sentences.sentence_ids[self.index]]
+
+    @property
+    def int_id(self):
+        return self.sentences.int_ids[self.index]
+
+    @property
+    def glue(self):
+        return bool(self.sentences.flags[self.index] & GLUE)
+
+    @property
+    def previous_glue(self):
+        return bool(self.sentences.flags[self.index] & PREVIOUS_GLUE)
+
+    @property
+    def fake_word(self):
+        return bool(self.sentences.flags[self.index] & FAKE_WORD)
+
+    def get_links(self, link):
+        """ Returns links of specific type. """
+        sentences = self.sentences
+        start = sentences.child_offsets[self.index]
+        end = sentences.child_offsets[self.index + 1]
+        if start == end:
+            return []
+
+        links = []
+        for l in link.split('|'):
+            deprel_id = sentences.strings.ids.get(l)
+            for i in range(start, end):
+                if sentences.child_deprels[i] == deprel_id:
+                    links.append(CompactWord(sentences, sentences.children[i]))
+        return links
@@ -1,21 +1,33 @@
 """
 A file for forming and saving outputs.
 """
+import copy
 import logging
 import os
 import shutil
 from pathlib import Path
 
+from cordex.matcher.match import StructureMatch
+from cordex.utils.parallel import ordered_imap, worker_state
 from cordex.utils.progress_bar import progress
 from cordex.writers.formatter import OutFormatter, OutNoStatFormatter
 from cordex.writers.collocation_sentence_mapper import CollocationSentenceMapper
 
+def _format_structure(structure_id, match_rows, representation_rows, with_map):
+    """ Forms output rows of a structure from its match and representation rows in a worker process. """
+    writer = worker_state['writer']
+    structure = worker_state['structures'][structure_id]
+    matches = StructureMatch.from_rows(writer.formatter.word_renderer.strings, {structure_id: structure}, match_rows,
+                                       representation_rows, writer.formatter.is_ud)
+    writer.formatter.set_structure(structure)
+    return writer.format_structure(structure, matches, with_map)
+
 
 class Writer:
     @staticmethod
     def other_params(args):
         """ Obtains and formats parameters that are needed for initialization of Writer class. """
-        return (args['multiple_output'], int(args['sort_by']), args['sort_reversed'], args['min_freq'])
+        return (args['multiple_output'], int(args['sort_by']), args['sort_reversed'], args['min_freq'], args['workers'])
 
     @staticmethod
     def make_output_writer(args, num_components, collocation_ids, word_renderer, is_ud):
@@ -36,11 +48,13 @@ class Writer:
             self.sort_by = -1
             self.sort_order = None
             self.min_frequency = 1
+            self.workers = 1
         else:
             self.multiple_output = params[0]
             self.sort_by = params[1]
             self.sort_order = params[2]
             self.min_frequency = params[3]
+            self.workers = params[4]
 
         self.num_components = num_components
         self.output_file = file_out
@@ -84,10 +98,13 @@ class Writer:
         else:
             file_handler.write(self.separator.join(self.header()) + "\n")
 
-    def write_out_worker(self, file_handler, structure, collocation_ids, col_sent_map, return_list):
+    def format_structure(self, structure, matches, with_map):
+        """ Forms sorted output rows of structure from its matches. When `with_map` is set, entries of collocation
+        sentence map are formed too. """
         rows = []
+        map_entries = []
         components = structure.components
-        for match in collocation_ids.get_matches_for(structure):
+        for match in matches:
             if len(match) < self.min_frequency:
                 continue
 
@@ -95,14 +112,14 @@ class Writer:
 
             variable_word_order = self.find_variable_word_order(match.matches)
 
-            if col_sent_map is not None:
+            if with_map:
                 for words in match.matches:
                     token_ids = []
                     for int_i in range(1, len(words) + 1):
                         str_i = str(int_i)
                         if str_i in words:
                             token_ids.append(f'{words[str_i].sentence_id}.{words[str_i].id}')
-                    col_sent_map.add_map(match.match_id, words['1'].sentence_id, '|'.join(token_ids))
+                    map_entries.append((match.match_id, words['1'].sentence_id, '|'.join(token_ids)))
 
             for words in match.matches:
                 to_write = []
@@ -131,6 +148,15 @@ class Writer:
 
         if rows != []:
             rows = self.sorted_rows(rows)
+        return rows, map_entries
+
+    def write_rows(self, file_handler, rows, map_entries, col_sent_map, return_list):
+        """ Writes formatted rows of a structure (see `format_structure`) to output. """
+        if col_sent_map is not None:
+            for collocation_id, sentence_id, token_ids in map_entries:
+                col_sent_map.add_map(collocation_id, sentence_id, token_ids)
+
+        if rows != []:
             if return_list:
                 return [row for row in rows]
             else:
@@ -141,6 +167,25 @@ class Writer:
             if return_list:
                 return []
 
+    def write_out_worker(self, file_handler, structure, collocation_ids, col_sent_map, return_list):
+        rows, map_entries = self.format_structure(structure, collocation_ids.get_matches_for(structure),
+                                                  col_sent_map is not None)
+        return self.write_rows(file_handler, rows, map_entries, col_sent_map, return_list)
+
+    def format_structures_parallel(self, structures, collocation_ids, word_renderer, with_map):
+        """ Forms output rows of structures (see `format_structure`) in multiple processes and yields them in order of
+        structures. Workers share read-only copies of matches and words `word_renderer` (see `MatchStore.snapshot` and
+        `WordStats.snapshot`). """
+        worker_writer = copy.copy(self)
+        worker_writer.formatter = type(self.formatter)(collocation_ids.snapshot(), word_renderer,
+                                                       self.formatter.is_ud, self.formatter.args)
+        storage = collocation_ids.storage
+
+        state = {'writer': worker_writer, 'structures': {s.id: s for s in structures}}
+        tasks = ((s.id, list(storage.match_rows(s.id)), list(storage.representation_rows(s.id)), with_map)
+                 for s in structures)
+        yield from ordered_imap(_format_structure, tasks, self.workers, state)
+
     def write_out(self, structures, collocation_ids, return_list=False):
         """ Writes processing results to file. """
         write_results = []
@@ -175,28 +220,45 @@ class Writer:
             col_sent_map = CollocationSentenceMapper(self.collocation_sentence_map_dest) \
                 if self.collocation_sentence_map_dest else None
 
-        for s in progress(structures, "writing:{}".format(self.formatter)):
-            if self.multiple_output:
+        # structures are formatted in parallel, but written in order, unless index of words does not fit into memory
+        structure_results = None
+        word_renderer = self.formatter.word_renderer.snapshot() if self.workers > 1 else None
+        if word_renderer is not None:
+            structure_results = self.format_structures_parallel(structures, collocation_ids, word_renderer,
+                                                                bool(self.collocation_sentence_map_dest))
+
+        # workers are stopped also when writing fails
+        try:
+            for s in progress(structures, "writing:{}".format(self.formatter)):
+                if self.multiple_output:
+
+                    if return_list:
+                        write_results.append(self.header())
+                    else:
+                        fp = fp_open(s.id)
+                        self.write_header(fp, return_list)
+                    if self.collocation_sentence_map_dest:
+                        Path(self.collocation_sentence_map_dest).mkdir(parents=True, exist_ok=True)
+                    col_sent_map = CollocationSentenceMapper(os.path.join(self.collocation_sentence_map_dest, f'{s.id}.tsv')) \
+                        if self.collocation_sentence_map_dest else None
+
+                self.formatter.set_structure(s)
+                if structure_results is not None:
+                    rows, map_entries = next(structure_results)
+                    content = self.write_rows(None if return_list else fp, rows, map_entries, col_sent_map, return_list)
+                else:
+                    content = self.write_out_worker(None if return_list else fp, s, collocation_ids, col_sent_map,
+                                                    return_list)
 
                 if return_list:
-                    write_results.append(self.header())
+                    write_results.extend(content)
                 else:
-                    fp = fp_open(s.id)
-                    self.write_header(fp, return_list)
-                if self.collocation_sentence_map_dest:
-                    Path(self.collocation_sentence_map_dest).mkdir(parents=True, exist_ok=True)
-                col_sent_map = CollocationSentenceMapper(os.path.join(self.collocation_sentence_map_dest, f'{s.id}.tsv')) \
-                    if self.collocation_sentence_map_dest else None
-
-            self.formatter.set_structure(s)
-            if return_list:
-                content = self.write_out_worker(None, s, collocation_ids, col_sent_map, return_list)
-                write_results.extend(content)
-            else:
-                self.write_out_worker(fp, s, collocation_ids, col_sent_map, return_list)
 
-                if self.multiple_output:
-                    fp_close(fp)
+                    if self.multiple_output:
+                        fp_close(fp)
+        finally:
+            if structure_results is not None:
+                structure_results.close()
 
         if not return_list:
             if not self.multiple_output:
@@ -6,6 +6,7 @@ import pickle
 import time
 from conversion_utils.jos_msds_and_properties import Msd, Converter
 
+from cordex.representations.lookup import write_indexed_lexicon
 from cordex.utils.converter import translate_msd
 
 
@@ -52,7 +53,20 @@ def fix_msd(msd, word_form):
     return msd
 
 
+def write_lexicon(lexicon, args):
+    if args.format == 'indexed':
+        write_indexed_lexicon(lexicon, args.output)
+    else:
+        with lzma.open(args.output, "wb") as f:
+            pickle.dump(lexicon, f)
+
+
 def main(args):
+    if args.lookup_lexicon:
+        with lzma.open(args.lookup_lexicon, "rb") as f:
+            write_lexicon(pickle.load(f), args)
+        return
+
     with open(args.sloleks_csv, newline='', encoding='utf-8') as f:
         sloleks_csv = csv.reader(f, delimiter='|')
         next(sloleks_csv, None)
@@ -118,14 +132,18 @@ def main(args):
         for k, v in connected_lemmas.items():
             if len(v) > 1:
                 connected_lemmas[k] = sorted(v, reverse=True, key=lambda x: x[3])
-    with lzma.open(args.output, "wb") as f:
-        pickle.dump(connected_lemmas, f)
+    write_lexicon(connected_lemmas, args)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='A script that prepares and formats lookup lexicon for cordex.')
     parser.add_argument('--sloleks_csv', type=str, help='Path to csv containing data saved as lemma|msd|form|frequency.')
     parser.add_argument('--output', type=str, help='Path to output file that will be used by cordex.')
+    parser.add_argument('--lookup_lexicon', type=str,
+                        help='Path to existing compressed lookup lexicon, that is converted instead of sloleks_csv.')
+    parser.add_argument('--format', type=str, default='xz', choices=['xz', 'indexed'],
+                        help='Format of output file, compressed ("xz") or memory-mapped with index of lemmas '
+                             '("indexed").')
     parser.add_argument('--lang', type=str, default='sl', help='Language of msds ("sl" or "en").')
     args = parser.parse_args()
 
@@ -1,9 +1,32 @@
 import filecmp
+import multiprocessing
 import os
+import pickle
 import shutil
+import sqlite3
+from collections import Counter, defaultdict
+from random import Random
+from xml.etree import ElementTree
 
 import pytest
 import cordex
+from cordex.database import sqlite_storage
+from cordex.database.memory_storage import MemoryStorage
+from cordex.database.sqlite_storage import SQLiteStorage
+from cordex.matcher import match_store
+from cordex.matcher.match import StructureMatch
+from cordex.matcher.match_store import MatchStore
+from cordex.postprocessors.postprocessor import Postprocessor
+from cordex.readers.loader import load_file, load_tei
+from cordex.representations import lookup
+from cordex.representations.lookup import LookupLexicon, write_indexed_lexicon
+from cordex.restrictions.restriction import Restriction
+from cordex.statistics.word_stats import WordStats
+from cordex.utils import parallel
+from cordex.utils.converter import decode_udpos, encode_udpos
+from cordex.words.compact import CompactWord, StringTable
+from cordex.words.word import WordJOS, WordUD
+from cordex.writers.writer import Writer
 from tests import *
 from tests.correct_output import OUTPUT_TOKEN_OUTPUT, OUTPUT_GET_LIST
 
@@ -145,3 +168,826 @@ def test_no_lookup_jos(clear_output):
     extraction = extractor(os.path.join(INPUT_DIR, "gigafida_example_tei_small"))
     extraction.write(output_dir, separator=',')
     compare_directories(os.path.join(CORRECT_OUTPUT_DIR, 'output_no_lookup'), os.path.join(OUTPUT_DIR))
+
+
+def stored_results(extraction):
+    """ Returns matched words, representations, words and dispersions of extraction with strings instead of their
+    ids, so that results of different storages may be compared. Component ids are strings, as storages may return
+    them as numbers. """
+    storage = extraction.match_store.storage
+    strings = storage.strings
+    return {
+        'matches': [tuple(row[:3]) + (str(row[3]),) + tuple(strings[string_id] for string_id in row[4:7]) +
+                    tuple(row[7:]) for row in storage.match_rows()],
+        'representations': [(collocation_id, str(component_id), text, msd)
+                            for collocation_id, component_id, text, msd in storage.representation_rows()],
+        'words': [(strings[lemma], strings[msd], strings[text], frequency)
+                  for _uw_id, lemma, msd, text, frequency in storage.words()],
+        'dispersions': extraction.match_store.dispersions,
+    }
+
+
+def test_workers(monkeypatch):
+    """ Test for processing multiple documents in multiple processes. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_UD.xml")
+    corpus = os.path.join(INPUT_DIR, "gigafida_example_conllu_small")
+    expected = stored_results(cordex.Pipeline(structures)(corpus))
+    assert expected['matches'] and expected['representations']
+
+    def extract(*args):
+        raise AssertionError('files should be matched in worker processes')
+    monkeypatch.setattr(cordex.Pipeline, 'extract', extract)
+
+    # results are stored in the same order as when files are matched one by one
+    assert stored_results(cordex.Pipeline(structures, workers=2)(corpus)) == expected
+
+
+def test_add_matches_in_batches(monkeypatch):
+    """ Test for inserting matches into storage in batches. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_UD.xml")
+    corpus = os.path.join(INPUT_DIR, "ssj500k.small.conllu")
+    expected = stored_results(cordex.Pipeline(structures)(corpus))
+
+    batch_sizes = []
+    add_matches = SQLiteStorage.add_matches
+
+    def add_matches_batch(storage, collocations, components, matches, collocation_matches, **kwargs):
+        batch_sizes.append(len(collocation_matches))
+        add_matches(storage, collocations, components, matches, collocation_matches, **kwargs)
+    monkeypatch.setattr(match_store, 'MATCH_BATCH_SIZE', 3)
+    monkeypatch.setattr(SQLiteStorage, 'add_matches', add_matches_batch)
+
+    assert stored_results(cordex.Pipeline(structures)(corpus)) == expected
+    assert max(batch_sizes) == 3
+    assert sum(batch_sizes) == len({row[2] for row in expected['matches']})
+
+
+def test_chunk_size():
+    """ Test for matching conllu document in chunks, whose matches wait in temporary file. """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), chunk_size=10)
+    corpus = os.path.join(INPUT_DIR, "ssj500k.small.conllu")
+    postprocessor = Postprocessor()
+
+    chunks = list(load_file(corpus, extractor.args))
+    assert len(chunks) > 1
+    assert all(sum(w.fake_word for w in words) <= 10 for words in chunks)
+
+    match_spool, word_counts, num_words = cordex.Pipeline.match_chunks(iter(chunks), extractor.structure_index,
+                                                                       postprocessor, extractor.args)
+    # only offsets of matches of chunks are kept in memory
+    assert os.path.exists(match_spool.path)
+    assert all(type(offset) == int for part in match_spool.parts for offset in part)
+
+    extractor.args['chunk_size'] = None
+    file_spool, file_word_counts, file_num_words = cordex.Pipeline.match_chunks(
+        load_file(corpus, extractor.args), extractor.structure_index, postprocessor, extractor.args)
+    assert file_spool.path is None
+    assert list(match_spool.rows()) == list(file_spool.rows())
+    assert not os.path.exists(match_spool.path)
+    assert (word_counts, num_words) == (file_word_counts, file_num_words)
+
+
+def test_match_spool_close(tmp_path):
+    """ Test for removing temporary file of matches, that are not read. """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), chunk_size=10)
+    chunks = list(load_file(os.path.join(INPUT_DIR, "ssj500k.small.conllu"), extractor.args))
+
+    with cordex.Pipeline.match_chunks(iter(chunks), extractor.structure_index, Postprocessor(), extractor.args,
+                                      str(tmp_path))[0] as match_spool:
+        assert os.listdir(tmp_path) == [os.path.basename(match_spool.path)]
+    assert os.listdir(tmp_path) == []
+
+    def failing_chunks():
+        yield from chunks[:2]
+        raise RuntimeError('corrupted file')
+    with pytest.raises(RuntimeError):
+        cordex.Pipeline.match_chunks(failing_chunks(), extractor.structure_index, Postprocessor(), extractor.args,
+                                     str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+TEI_SENTENCES = """<?xml version="1.0" encoding="utf-8"?>
+<body xmlns="http://www.tei-c.org/ns/1.0">
+   <p xml:id="doc.1">
+      <s xml:id="doc.1.1">
+<w msd="UPosTag=NOUN|Case=Nom|Number=Sing" lemma="miza" xml:id="doc.1.1.t1">Miza</w>
+<linkGrp corresp="#doc.1.1" targFunc="head argument" type="UD-SYN">
+<link ana="ud-syn:root" target="#doc.1.1 #doc.1.1.t1"/>
+</linkGrp>
+      </s>
+      <s xml:id="doc.1.2">
+<w msd="UPosTag=ADJ|Case=Nom|Number=Sing" lemma="lesen" xml:id="doc.1.2.t1">lesena</w>
+<w msd="UPosTag=NOUN|Case=Nom|Number=Sing" lemma="miza" xml:id="doc.1.2.t2">miza</w>
+<linkGrp corresp="#doc.1.2" targFunc="head argument" type="UD-SYN">
+<link ana="ud-syn:root" target="#doc.1.2 #doc.1.2.t2"/>
+<link ana="ud-syn:amod" target="#doc.1.2.t2 #doc.1.2.t1"/>
+<link ana="ud-syn:nmod" target="#doc.1.2.t2 #doc.1.1.t1"/>
+</linkGrp>
+      </s>
+   </p>
+</body>
+"""
+
+
+@pytest.mark.parametrize("compact_words", [False, True])
+def test_tei_chunk_size(tmp_path, caplog, compact_words):
+    """ Test for reading tei document incrementally in chunks, where links to sentences of previous chunks are
+    skipped. """
+    corpus = tmp_path / "corpus.xml"
+    corpus.write_text(TEI_SENTENCES, encoding="utf-8")
+
+    def load(chunk_size):
+        args = cordex.Pipeline.set_default_args({'is_ud': True, 'chunk_size': chunk_size,
+                                                 'compact_words': compact_words})
+        return list(load_file(str(corpus), args))
+
+    # links between sentences are kept when file is not read in chunks or they are in the same chunk
+    for chunks in [load(None), load(2)]:
+        assert len(chunks) == 1
+        _root, first_noun, _root, adjective, noun = chunks[0]
+        assert noun.get_links('amod') == [adjective]
+        assert noun.get_links('nmod') == [first_noun]
+    assert 'Unknown id' not in caplog.text
+
+    chunks = load(1)
+    assert [[w.lemma for w in words if not w.fake_word] for words in chunks] == [['miza'], ['lesen', 'miza']]
+    _root, adjective, noun = chunks[1]
+    assert noun.get_links('amod') == [adjective]
+    assert noun.get_links('nmod') == []
+    assert 'Unknown id: doc.1.1.t1' in caplog.text
+
+    # whole file may still be loaded at once
+    assert len(list(load_tei(str(corpus)).iter('s'))) == 2
+
+
+def test_morphology_restriction_cache(monkeypatch):
+    """ Test for checking morphology restrictions once per msd. """
+    restriction = Restriction(ElementTree.fromstring(
+        '<restriction type="morphology"><feature POS="noun"/><feature case="genitive"/>'
+        '<feature number="dual" filter="negative"/></restriction>'), is_ud=False)
+    matcher = restriction.matcher
+    msds = ['Ncmsg', 'Ncfpg', 'Ncmdg', 'Ncmsn', 'Agpmsg', '']
+    expected = [True, True, False, False, False, False]
+
+    assert [matcher(msd, 'lemma') for msd in msds] == expected
+    assert matcher.cache == dict(zip(msds, expected))
+
+    def match_msd(text):
+        raise AssertionError('checked msds should not be checked again')
+    monkeypatch.setattr(matcher, 'match_msd', match_msd)
+    assert [matcher(msd, 'lemma') for msd in msds] == expected
+
+
+@pytest.mark.parametrize("structures, corpus, kwargs, msd", [
+    ("structures_UD.xml", "ssj500k.small.conllu", {}, "udpos"),
+    ("structures_JOS.xml", "ssj500k.small.xml", {'jos_msd_lang': 'sl'}, "xpos"),
+])
+def test_compact_words(structures, corpus, kwargs, msd):
+    """ Test for matching compact words, that are views into columns of loaded sentences. """
+    structures = os.path.join(STRUCTURES_DIR, structures)
+    corpus = os.path.join(INPUT_DIR, corpus)
+    extractor = cordex.Pipeline(structures, compact_words=True, **kwargs)
+    compact_words = [w for words in load_file(corpus, extractor.args) for w in words]
+    extractor.args['compact_words'] = False
+    words = [w for words in load_file(corpus, extractor.args) for w in words]
+
+    assert all(isinstance(w, CompactWord) for w in compact_words)
+    assert len(compact_words) == len(words)
+    for compact_word, word in zip(compact_words, words):
+        for attribute in ['lemma', 'text', msd, 'id', 'sentence_id', 'int_id', 'glue', 'previous_glue', 'fake_word']:
+            assert getattr(compact_word, attribute) == getattr(word, attribute)
+        for deprel in word.links:
+            assert [w.id for w in compact_word.get_links(deprel)] == [w.id for w in word.get_links(deprel)]
+
+    assert stored_results(cordex.Pipeline(structures, compact_words=True, **kwargs)(corpus)) == \
+           stored_results(cordex.Pipeline(structures, **kwargs)(corpus))
+
+
+def test_reused_db(tmp_path):
+    """ Test for strings interned in database, that are reused when results are read from existing database. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_UD.xml")
+    corpus = os.path.join(INPUT_DIR, "gigafida_example_conllu_small")
+    db = str(tmp_path / "cordex.db")
+    expected = stored_results(cordex.Pipeline(structures, db=db, overwrite_db=True)(corpus))
+
+    extraction = cordex.Pipeline(structures, db=db)(corpus)
+    storage = extraction.match_store.storage
+    storage.commit()
+    strings = [string for string, in storage.db.execute("SELECT string FROM Strings ORDER BY string_id")]
+    assert strings == storage.strings.values
+    assert len(set(strings)) == len(strings)
+
+    # matches and words refer to strings by their ids
+    for row in storage.db.execute("SELECT word_lemma, word_text, word_udpos FROM Matches"):
+        assert all(type(string_id) == int for string_id in row)
+    for row in storage.db.execute("SELECT lemma, udpos, upos, text FROM UniqWords"):
+        assert all(type(string_id) == int for string_id in row)
+    assert stored_results(extraction) == expected
+
+
+def test_old_db(tmp_path):
+    """ Test for rejecting database created by an older version, whose tables are different. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_UD.xml")
+    corpus = os.path.join(INPUT_DIR, "ssj500k.small.conllu")
+    db = str(tmp_path / "cordex.db")
+    old_db = sqlite3.connect(db)
+    old_db.execute("CREATE TABLE StepsDone ( step varchar(32) )")
+    old_db.commit()
+    old_db.close()
+
+    with pytest.raises(ValueError, match="overwrite_db=True"):
+        cordex.Pipeline(structures, db=db)(corpus)
+    expected = stored_results(cordex.Pipeline(structures)(corpus))
+    assert stored_results(cordex.Pipeline(structures, db=db, overwrite_db=True)(corpus)) == expected
+    assert stored_results(cordex.Pipeline(structures, db=db)(corpus)) == expected
+
+
+def test_collocation_keys():
+    """ Test for collocations keyed by ids of their components and of their lemmas. """
+    strings = StringTable()
+    assert MatchStore.collocation_key(('5', [1, 'lesen'], [2, 'miza']), strings.get_id) == '1:0 2:1'
+    assert MatchStore.collocation_key(('6', [1, 'miza'], [3, 'lesen']), strings.get_id) == '1:1 3:0'
+
+    extraction = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"))(
+        os.path.join(INPUT_DIR, "gigafida_example_conllu_small"))
+    storage = extraction.match_store.storage
+    components = defaultdict(list)
+    for collocation_id, component_id, lemma in storage.db.execute(
+            "SELECT collocation_id, component_id, lemma FROM CollocationComponents ORDER BY rowid"):
+        components[collocation_id].append(f'{component_id}:{lemma}')
+
+    collocation_keys = list(storage.collocation_keys())
+    assert len({(structure_id, key) for _collocation_id, structure_id, key in collocation_keys}) == \
+           len(collocation_keys) > 0
+    assert extraction.match_store.collocation_ids == {(structure_id, key): collocation_id
+                                                     for collocation_id, structure_id, key in collocation_keys}
+    for collocation_id, _structure_id, key in collocation_keys:
+        assert key == ' '.join(components[collocation_id])
+
+
+@pytest.mark.parametrize("min_freq", [0, 2, 3])
+def test_collocation_dispersions(min_freq):
+    """ Test for dispersions of components of frequent collocations, that are counted in a single query. """
+    extraction = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), min_freq=min_freq)(
+        os.path.join(INPUT_DIR, "gigafida_example_conllu_small"))
+    storage = extraction.match_store.storage
+    frequencies = Counter(collocation_id for collocation_id, _structure_id, _match_id
+                          in {tuple(row[:3]) for row in storage.match_rows()})
+
+    dispersions = Counter()
+    for collocation_id, structure_id, component_id, lemma in storage.db.execute(
+            """SELECT collocation_id, structure_id, component_id, lemma FROM Collocations
+            JOIN CollocationComponents USING (collocation_id)"""):
+        if frequencies[collocation_id] >= min_freq:
+            dispersions[(str(structure_id), component_id, storage.strings[lemma])] += 1
+    assert dispersions
+    assert extraction.match_store.dispersions == dispersions
+
+
+def structure_match_contents(match):
+    """ Returns collocation id, structure id, representations and matched words of structure match. """
+    return (int(match.match_id), match.structure.id, match.representations,
+            [{component_id: (w.lemma, w.text, w.udpos, w.id, w.sentence_id) for component_id, w in words.items()}
+             for words in match.matches])
+
+
+def test_matches_from_db_bulk():
+    """ Test for loading matches of many collocations in a single ordered pass. """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"))
+    extraction = extractor(os.path.join(INPUT_DIR, "gigafida_example_conllu_small"))
+    storage = extraction.match_store.storage
+    structures = {s.id: s for s in extractor.structures}
+
+    matches = [structure_match_contents(match)
+               for match in StructureMatch.from_db_bulk(storage, extractor.structures, is_ud=True)]
+    assert [collocation_id for collocation_id, *_ in matches] == \
+           [collocation_id for collocation_id, _structure_id in storage.collocations()]
+    assert all(representations and words for _collocation_id, _structure_id, representations, words in matches)
+
+    # matches are equal to matches of a single collocation or structure
+    assert matches == [structure_match_contents(StructureMatch.from_db(storage, collocation_id, structures[structure_id],
+                                                                       is_ud=True))
+                       for collocation_id, structure_id in storage.collocations()]
+    structure_matches = [structure_match_contents(match) for structure in extractor.structures
+                         for match in extraction.match_store.get_matches_for(structure)]
+    assert sorted(structure_matches, key=lambda match: match[0]) == matches
+
+
+def lowercase_words_one_by_one(words, threshold=0.1):
+    """ Lowercases words (uw_id, lemma, msd, text, frequency) one by one in order of ids and returns their texts. """
+    texts = {uw_id: text for uw_id, _lemma, _msd, text, _freq in words}
+    for uw_id, lemma, msd, _text, freq in words:
+        text = texts[uw_id]
+        if not text[0].isupper():
+            continue
+        options = [lc_freq for lc_uw_id, lc_lemma, lc_msd, _lc_text, lc_freq in words
+                   if (lc_lemma, lc_msd, texts[lc_uw_id]) == (lemma, msd, text.lower())]
+        if any(freq >= lc_freq >= freq * threshold for lc_freq in options):
+            for other_uw_id, other_lemma, other_msd, _other_text, _other_freq in words:
+                if (other_lemma, other_msd, texts[other_uw_id]) == (lemma, msd, text):
+                    texts[other_uw_id] = text.lower()
+    return texts
+
+
+@pytest.mark.parametrize("storage_class", [SQLiteStorage, MemoryStorage])
+def test_lowercase_words_under_threshold(storage_class):
+    """ Test for lowercasing words in a single pass, that is equal to lowercasing words one by one. """
+    random = Random(7)
+    args = cordex.Pipeline.set_default_args({'is_ud': False})
+    forms = [(lemma, msd, text) for lemma in ['miza', 'Ljubljana'] for msd in ['Ncfsn', 'Npfsn']
+             for text in ['Miza', 'miza', 'MIZA', 'Ljubljana', 'ljubljana']]
+    for _ in range(20):
+        storage = storage_class(args)
+        word_stats = WordStats(args, storage)
+        word_stats.add_word_counts(Counter({form: random.randint(1, 30) for form in random.sample(forms, 12)}), 100)
+        strings = storage.strings
+        words = [(uw_id, strings[lemma], strings[msd], strings[text], freq)
+                 for uw_id, lemma, msd, text, freq in storage.words()]
+
+        word_stats.lowercase_words_under_threshold()
+        assert {uw_id: strings[text] for uw_id, _lemma, _msd, text, _freq in storage.words()} == \
+               lowercase_words_one_by_one(words)
+
+
+@pytest.mark.parametrize("storage", ["sqlite", "memory"])
+@pytest.mark.parametrize("structures, corpus, kwargs", [
+    ("structures_UD.xml", "ssj500k.small.conllu", {}),
+    ("structures_JOS.xml", "ssj500k.small.xml", {'jos_msd_lang': 'sl'}),
+])
+def test_generate_word_counts(storage, structures, corpus, kwargs):
+    """ Test for word counts, that sum frequencies of words per lemma and upos (or the first letter of xpos). """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, structures), storage=storage, **kwargs)
+    extraction = extractor(os.path.join(INPUT_DIR, corpus))
+    storage = extraction.word_stats.storage
+    strings = storage.strings
+    is_ud = extractor.args['is_ud']
+
+    word_counts = Counter()
+    for _uw_id, lemma, msd, _text, frequency in storage.words():
+        word_counts[(lemma, decode_udpos(strings[msd])['POS'] if is_ud else strings[msd][0])] += frequency
+    assert word_counts
+    assert {(lemma, msd0): frequency for lemma, msd0, frequency in storage.all_word_counts()} == word_counts
+    assert len(list(storage.all_word_counts())) == len(word_counts)
+
+
+def test_word_index_memory():
+    """ Test for index of words of recently used lemmas, when index of all words does not fit into memory. """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), word_index_memory=0.001)
+    extraction = extractor(os.path.join(INPUT_DIR, "ssj500k.small.conllu"))
+    extraction.get_list()
+    word_stats = extractor.word_stats
+
+    # index of all words is not loaded, so it may not be shared with workers
+    assert word_stats.index is None
+    assert word_stats.snapshot() is None
+    cache = word_stats.lemma_words.cache_info()
+    assert cache.hits > 0
+    assert cache.currsize <= cache.maxsize < word_stats.storage.num_word_rows()[1]
+
+    lemmas = sorted({word_stats.strings[lemma] for lemma, _msd, _text, _freq in word_stats.storage.all_words()})
+    cached_words = [list(word_stats.available_words(lemma)) for lemma in lemmas]
+
+    word_stats.load_index(256)
+    assert word_stats.index is not None
+    assert word_stats.snapshot() is word_stats.snapshot()
+    assert [list(word_stats.available_words(lemma)) for lemma in lemmas] == cached_words
+
+
+def test_bulk_db_profile(tmp_path):
+    """ Test for database in bulk load mode, whose indexes are created after loading files. """
+    args = cordex.Pipeline.set_default_args({'db': str(tmp_path / "cordex.db"), 'db_profile': 'bulk',
+                                             'db_pragmas': {'cache_size': -2000}, 'is_ud': True})
+    storage = SQLiteStorage(args)
+    database = storage.db
+
+    assert database.execute("PRAGMA journal_mode").fetchone()[0] == 'off'
+    assert database.execute("PRAGMA synchronous").fetchone()[0] == 0
+    assert database.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    assert database.commit_files == 100
+
+    def indexes():
+        return {row[0] for row in database.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+
+    deferred_indexes = {statement.split(' ON ')[0].split()[-1] for statement in database.deferred_indexes}
+    assert deferred_indexes
+    assert not deferred_indexes & indexes()
+    storage.loading_done()
+    assert deferred_indexes <= indexes()
+    assert not database.deferred_indexes
+
+
+def test_deferred_indexes(tmp_path):
+    """ Test for indexes, that are only created after loading files in bulk load mode and in memory. """
+    db = str(tmp_path / "cordex.db")
+
+    def indexes(database):
+        return {row[0] for row in database.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+
+    # indexes of databases in memory are created after loading
+    extraction = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"))(
+        os.path.join(INPUT_DIR, "ssj500k.small.conllu"))
+    assert {'key_sid_c', 'mid_m', 'lemma_on_uw', 'disp_key'} <= indexes(extraction.match_store.storage.db)
+
+    args = cordex.Pipeline.set_default_args({'db': db, 'is_ud': True})
+    safe_storage = SQLiteStorage(args)
+    assert not safe_storage.db.deferred_indexes
+    all_indexes = indexes(safe_storage.db)
+    safe_storage.db.db.close()
+
+    # database, whose loading was interrupted in bulk load mode, gets its indexes when it is opened again
+    args = cordex.Pipeline.set_default_args({'db': db, 'overwrite_db': True, 'db_profile': 'bulk', 'is_ud': True})
+    bulk_storage = SQLiteStorage(args)
+    bulk_storage.commit()
+    assert indexes(bulk_storage.db) < all_indexes
+    bulk_storage.db.db.close()
+
+    args = cordex.Pipeline.set_default_args({'db': db, 'is_ud': True})
+    assert indexes(SQLiteStorage(args).db) == all_indexes
+
+
+def test_invalid_db_profile(tmp_path):
+    """ Test for rejecting unknown database profiles and invalid pragmas. """
+    for settings in [{'db_profile': 'fastest'}, {'db_pragmas': {'page_size': 4096}},
+                     {'db_pragmas': {'journal_mode': 'WAL; DROP TABLE Files'}}, {'db_pragmas': {'cache_size': '-2000'}},
+                     {'db_pragmas': {'commit_files': 0}}]:
+        args = cordex.Pipeline.set_default_args({'db': str(tmp_path / "cordex.db"), 'is_ud': True, **settings})
+        with pytest.raises(ValueError):
+            SQLiteStorage(args)
+    assert not os.path.exists(tmp_path / "cordex.db")
+
+
+@pytest.mark.parametrize("structures, corpus, kwargs", [
+    ("structures_UD.xml", "gigafida_example_conllu_small", {}),
+    ("structures_JOS.xml", "ssj500k.small.xml", {'jos_msd_lang': 'sl'}),
+])
+def test_memory_storage(structures, corpus, kwargs):
+    """ Test for storing results in memory without sqlite, which gives the same results as sqlite storage. """
+    structures = os.path.join(STRUCTURES_DIR, structures)
+    corpus = os.path.join(INPUT_DIR, corpus)
+    memory = cordex.Pipeline(structures, storage='memory', **kwargs)(corpus)
+    sqlite = cordex.Pipeline(structures, **kwargs)(corpus)
+    assert isinstance(memory.match_store.storage, MemoryStorage)
+    assert stored_results(memory) == stored_results(sqlite)
+
+    def queries(extraction):
+        storage = extraction.match_store.storage
+        strings = storage.strings
+        lemmas = sorted({strings[lemma] for lemma, _msd, _text, _freq in storage.all_words()})
+        return {
+            'structure_matches': [[tuple(row[:3]) for row in storage.match_rows(structure_id=s.id)]
+                                  for s in extraction.structures],
+            'collocation_matches': [[tuple(row[:3]) for row in storage.match_rows(collocation_id=collocation_id)]
+                                    for collocation_id, _structure_id in storage.collocations()],
+            'dispersions': sorted((str(structure_id), str(component_id), strings[lemma], dispersion)
+                                  for structure_id, component_id, lemma, dispersion
+                                  in storage.collocation_dispersions(2)),
+            'lemma_words': [[(strings[msd], strings[text], freq)
+                             for msd, text, freq in storage.lemma_words(strings.ids[lemma])] for lemma in lemmas],
+            'lemma_word_counts': [sorted(storage.lemma_word_counts(strings.ids[lemma])) for lemma in lemmas],
+            'num_words': (storage.num_all_words(), storage.num_word_rows(), storage.num_collocations()),
+        }
+    assert queries(memory) == queries(sqlite)
+
+    with pytest.raises(ValueError):
+        cordex.Pipeline(structures, storage='memory', db='cordex.db', **kwargs)(corpus)
+
+
+def test_sharded_storage(tmp_path):
+    """ Test for storing collocations and matches of every structure in one of several database files. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_UD.xml")
+    corpus = os.path.join(INPUT_DIR, "gigafida_example_conllu_small")
+    db = str(tmp_path / "cordex.db")
+    expected = stored_results(cordex.Pipeline(structures)(corpus))
+
+    extraction = cordex.Pipeline(structures, db=db, storage='sharded', shards=3)(corpus)
+    storage = extraction.match_store.storage
+    assert stored_results(extraction) == expected
+    assert sorted(os.listdir(tmp_path)) == ['cordex.db', 'cordex.shard0.db', 'cordex.shard1.db', 'cordex.shard2.db']
+
+    # every shard holds collocations and matches of its structures only
+    num_collocations = []
+    for shard, schema in enumerate(storage.schemas()):
+        structure_ids = {structure_id for structure_id, in storage.db.execute(
+            f"SELECT DISTINCT structure_id FROM {schema}Collocations")}
+        assert all(storage.structure_shard(structure_id) == shard for structure_id in structure_ids)
+        num_collocations.append(storage.db.execute(f"SELECT COUNT(*) FROM {schema}Collocations").fetchone()[0])
+        assert storage.db.execute(f"""SELECT COUNT(*) FROM {schema}Matches WHERE match_id NOT IN
+                                  (SELECT mid_match_id FROM {schema}CollocationMatches)""").fetchone()[0] == 0
+    assert len([n for n in num_collocations if n > 0]) > 1
+    assert sum(num_collocations) == storage.num_collocations() == len(set(row[0] for row in expected['matches']))
+    storage.db.db.close()
+
+    # results are read from existing shards
+    assert stored_results(cordex.Pipeline(structures, db=db, storage='sharded', shards=3)(corpus)) == expected
+
+    with pytest.raises(ValueError):
+        cordex.Pipeline(structures, db=db, storage='sharded', shards=0)(corpus)
+    os.remove(db)
+    with pytest.raises(ValueError):
+        cordex.Pipeline(structures, db=db, storage='sharded', shards=3)(corpus)
+
+
+def test_collocation_batches():
+    """ Test for splitting match rows into batches of whole collocations. """
+    rows = [(1, 'a'), (1, 'b'), (2, 'c'), (4, 'd'), (4, 'e'), (5, 'f'), (6, 'g')]
+    assert list(MatchStore.collocation_batches(iter(rows), 2)) == [rows[:3], rows[3:6], rows[6:]]
+    assert list(MatchStore.collocation_batches(iter(rows), 5)) == [rows]
+    assert list(MatchStore.collocation_batches(iter([]), 2)) == []
+
+
+@pytest.mark.parametrize("structures, corpus, kwargs", [
+    ("structures_UD.xml", "gigafida_example_conllu_small", {}),
+    ("structures_JOS.xml", "gigafida_example_tei_small", {'jos_msd_lang': 'sl'}),
+])
+def test_parallel_representations(monkeypatch, structures, corpus, kwargs):
+    """ Test for forming representations of batches of collocations in multiple processes. """
+    structures = os.path.join(STRUCTURES_DIR, structures)
+    corpus = os.path.join(INPUT_DIR, corpus)
+    expected = stored_results(cordex.Pipeline(structures, **kwargs)(corpus))
+
+    parallel_calls = []
+    set_representations_parallel = MatchStore.set_representations_parallel
+
+    def set_representations_batches(store, *args, **call_kwargs):
+        parallel_calls.append(store)
+        set_representations_parallel(store, *args, **call_kwargs)
+    monkeypatch.setattr(match_store, 'REPRESENTATION_BATCH_SIZE', 7)
+    monkeypatch.setattr(MatchStore, 'set_representations_parallel', set_representations_batches)
+
+    assert stored_results(cordex.Pipeline(structures, workers=2, **kwargs)(corpus)) == expected
+    assert len(parallel_calls) == 1
+
+    # without index of words in memory representations are formed in a single process
+    assert stored_results(cordex.Pipeline(structures, workers=2, word_index_memory=0, **kwargs)(corpus)) == expected
+    assert len(parallel_calls) == 1
+
+
+@pytest.mark.parametrize("statistics", [True, False])
+def test_parallel_writer(monkeypatch, tmp_path, statistics):
+    """ Test for formatting output structures in multiple processes, that are written in order of structures. """
+    extraction = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), statistics=statistics)(
+        os.path.join(INPUT_DIR, "gigafida_example_conllu_small"))
+    (tmp_path / "out").mkdir()
+
+    def outputs():
+        extraction.args['collocation_sentence_map_dest'] = str(tmp_path / "mapper.csv")
+        extraction.write(str(tmp_path / "out.csv"), separator=',')
+        extraction.args['collocation_sentence_map_dest'] = str(tmp_path / "mapper")
+        extraction.write(str(tmp_path / "out"), separator=',')
+        files = {}
+        for path in ["out.csv", "mapper.csv"] + [os.path.join(directory, name) for directory in ["out", "mapper"]
+                                                 for name in os.listdir(tmp_path / directory)]:
+            with open(tmp_path / path, encoding="utf-8") as f:
+                files[path] = f.read()
+        extraction.args['collocation_sentence_map_dest'] = None
+        return files, extraction.get_list(separator=',')
+    expected = outputs()
+    assert len(expected[0]) > 2 and len(expected[1]) > 1
+
+    parallel_calls = []
+    format_structures_parallel = Writer.format_structures_parallel
+
+    def format_structures(writer, *args, **kwargs):
+        parallel_calls.append(writer)
+        return format_structures_parallel(writer, *args, **kwargs)
+    monkeypatch.setattr(Writer, 'format_structures_parallel', format_structures)
+
+    extraction.args['workers'] = 2
+    assert outputs() == expected
+    assert len(parallel_calls) == 3
+
+
+def test_parallel_writer_error(monkeypatch, tmp_path):
+    """ Test for stopping worker processes, when writing of structures fails. """
+    extraction = cordex.Pipeline(os.path.join(STRUCTURES_DIR, "structures_UD.xml"), workers=2)(
+        os.path.join(INPUT_DIR, "gigafida_example_conllu_small"))
+
+    def write_rows(*args):
+        raise OSError('no space left on device')
+    monkeypatch.setattr(Writer, 'write_rows', write_rows)
+    # traceback keeps writer alive, so workers are not stopped by garbage collection
+    with pytest.raises(OSError) as error:
+        extraction.write(str(tmp_path / "out.csv"))
+    assert error.traceback
+    assert multiprocessing.active_children() == []
+
+
+def test_shared_lookup_lexicon(tmp_path):
+    """ Test for lookup lexicon shared between pipelines, until its file is modified. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_JOS.xml")
+    lookup_lexicon = str(tmp_path / "lexicon.idx")
+    other_lookup_lexicon = str(tmp_path / "other_lexicon.idx")
+    write_indexed_lexicon({'miza': [({}, 'miza', 'Sozei', 1)]}, lookup_lexicon)
+    write_indexed_lexicon({'miza': [({}, 'miza', 'Sozei', 1)]}, other_lookup_lexicon)
+
+    shared = cordex.Pipeline(structures, lookup_lexicon=lookup_lexicon).lookup_lexicon
+    assert shared.file_data['miza'] == [({}, 'miza', 'Sozei', 1)]
+    assert cordex.Pipeline(structures, lookup_lexicon=os.path.join(str(tmp_path), ".", "lexicon.idx"),
+                           jos_msd_lang='sl').lookup_lexicon is shared
+    assert cordex.Pipeline(structures, lookup_lexicon=other_lookup_lexicon).lookup_lexicon is not shared
+
+    # replaced file is loaded again
+    modified = os.path.getmtime(lookup_lexicon) + 10
+    write_indexed_lexicon({'mizica': [({}, 'mizica', 'Sozei', 1)]}, str(tmp_path / "new_lexicon.idx"))
+    os.utime(tmp_path / "new_lexicon.idx", (modified, modified))
+    os.replace(tmp_path / "new_lexicon.idx", lookup_lexicon)
+    reloaded = cordex.Pipeline(structures, lookup_lexicon=lookup_lexicon).lookup_lexicon
+    assert reloaded is not shared
+    assert 'miza' not in reloaded.file_data and 'mizica' in reloaded.file_data
+    assert cordex.Pipeline(structures, lookup_lexicon=lookup_lexicon).lookup_lexicon is reloaded
+
+
+def test_lookup_lexicon_in_workers(monkeypatch, tmp_path):
+    """ Test for passing only path of lookup lexicon to workers forming representations. """
+    structures = os.path.join(STRUCTURES_DIR, "structures_JOS.xml")
+    corpus = os.path.join(INPUT_DIR, "ssj500k.small.xml")
+    lookup_lexicon = str(tmp_path / "lexicon.idx")
+    write_indexed_lexicon({'biti': [({}, 'biti', 'Gp-ste-n', 1)]}, lookup_lexicon)
+    expected = stored_results(cordex.Pipeline(structures, lookup_lexicon=lookup_lexicon, jos_msd_lang='sl')(corpus))
+
+    states = []
+
+    def ordered_imap(function, tasks, workers, state):
+        # tasks are processed in this process, as by a worker, that did not inherit lexicon
+        states.append(state)
+        monkeypatch.setattr(lookup, '_loaded_lexicons', {})
+        monkeypatch.setattr(parallel, 'worker_state', dict(pickle.loads(pickle.dumps(state))))
+        monkeypatch.setattr(match_store, 'worker_state', parallel.worker_state)
+        for task in tasks:
+            yield function(*task)
+    monkeypatch.setattr(match_store, 'ordered_imap', ordered_imap)
+
+    assert stored_results(cordex.Pipeline(structures, lookup_lexicon=lookup_lexicon, jos_msd_lang='sl',
+                                          workers=2)(corpus)) == expected
+    assert [state['lookup_lexicon_path'] for state in states] == [lookup_lexicon]
+    assert not any(isinstance(value, LookupLexicon) for value in states[0].values())
+
+
+def test_indexed_lookup_lexicon(tmp_path):
+    """ Test for reading lemmas from indexed lookup lexicon. """
+    lexicon = {
+        'žaba': [({'case': 'nominative', 'number': 'singular'}, 'žaba', 'Sozei', 20),
+                 ({'case': 'genitive', 'number': 'singular'}, 'žabe', 'Sozer', 5)],
+        'čebela': [({'case': 'nominative', 'number': 'singular'}, 'čebela', 'Sozei', 10)],
+        'zebra': [({'case': 'nominative', 'number': 'singular'}, 'zebra', 'Sozei', 3)],
+        'a': [({}, 'a', 'Vp', 100)],
+    }
+    lookup_lexicon = str(tmp_path / "lexicon.idx")
+    write_indexed_lexicon(lexicon, lookup_lexicon)
+
+    file_data = LookupLexicon(lookup_lexicon).file_data
+    assert len(file_data) == len(lexicon)
+    for lemma, forms in lexicon.items():
+        assert lemma in file_data
+        assert file_data[lemma] == forms
+    assert 'žabe' not in file_data
+    assert file_data.get('žabe') is None
+    with pytest.raises(KeyError):
+        file_data['žabe']
+
+    # memory map is opened again in other processes
+    assert pickle.loads(pickle.dumps(file_data))['čebela'] == lexicon['čebela']
+
+
+def test_lookup_lexicon_find_form(tmp_path):
+    """ Test for finding forms of lemma in lookup lexicon by features. """
+    forms = [({'case': 'nominative', 'number': 'singular'}, 'miza', 'Sozei', 30),
+             ({'case': 'genitive', 'number': 'singular'}, 'mize', 'Sozer', 20),
+             ({'case': 'nominative', 'number': 'plural'}, 'mize', 'Sozmi', 10),
+             ({'case': 'genitive', 'number': 'plural'}, 'miz', 'Sozmr', 5)]
+    lookup_lexicon = str(tmp_path / "lexicon.idx")
+    write_indexed_lexicon({'miza': forms}, lookup_lexicon)
+    lexicon = LookupLexicon(lookup_lexicon)
+
+    def linear_scan(form_features):
+        for form in forms:
+            if all(form[0].get(name) == value for name, value in form_features.items()):
+                return form
+        return forms[-1]
+
+    for form_features in [{}, {'case': 'genitive'}, {'number': 'plural'}, {'case': 'nominative', 'number': 'plural'},
+                          {'case': 'dative'}, {'case': 'genitive', 'gender': 'feminine'}]:
+        assert lexicon.find_form('miza', form_features) == linear_scan(form_features)
+    assert lexicon.find_form('miza', {}) == forms[0]
+    assert lexicon.find_form('miza', {'case': 'genitive', 'number': 'plural'}) == forms[3]
+    assert lexicon.find_form('miza', {'case': 'dative'}) == forms[-1]
+
+    # repeated requests are memoized
+    data = {'msd': {'Case': 'Genitive', 'Number': 'Plural'}}
+    assert lexicon.get_word_form('miza', None, data) == ('Sozmr', 'miza', 'miz')
+    assert lexicon.get_word_form('miza', None, data) == ('Sozmr', 'miza', 'miz')
+    assert lexicon.cached_word_form.cache_info().hits == 1
+    assert lexicon.get_word_form('stol', None, data) == (None, None, None)
+
+
+@pytest.mark.parametrize("udpos", [
+    {},
+    {'POS': 'NOUN'},
+    {'POS': 'NOUN', 'Case': 'Nom', 'Gender': 'Masc', 'Number': 'Sing'},
+    {'POS': 'PRON', 'Number[psor]': 'Plur', 'Poss': 'Yes', 'Case': 'Acc'},
+])
+def test_udpos_encoding(udpos):
+    encoded = encode_udpos(udpos)
+    decoded = decode_udpos(encoded)
+    if not udpos:
+        assert encoded == '' and decoded == ''
+        return
+    assert encoded == '|'.join(f'{k}={v}' for k, v in udpos.items())
+    assert decoded == udpos
+    assert list(decoded.items()) == list(udpos.items())
+    assert encode_udpos(decoded) == encoded
+    with pytest.raises(TypeError):
+        decoded['POS'] = 'VERB'
+
+
+@pytest.mark.parametrize("upsert_supported", [True, False])
+def test_add_word_counts(monkeypatch, upsert_supported):
+    """ Test for adding frequencies of words counted per file, with and without sqlite upserts. """
+    monkeypatch.setattr(sqlite_storage, 'UPSERT_SUPPORTED', upsert_supported)
+    storage = SQLiteStorage(cordex.Pipeline.set_default_args({'is_ud': False}))
+    storage.add_word_counts([((1, 2, 3), (5, None)), ((1, 2, 4), (1, None))], 8)
+    storage.add_word_counts([((1, 2, 4), (2, None)), ((6, 2, 7), (1, None))], 4)
+
+    assert list(storage.words()) == [(1, 1, 2, 3, 5), (2, 1, 2, 4, 3), (3, 6, 2, 7, 1)]
+    assert storage.num_all_words() == 12
+
+
+def write_structures(path, system_type, root_restrictions):
+    """ Writes structures of two components, whose roots have given restrictions, and returns their path. """
+    label = 'amod' if system_type == 'UD' else 'ena'
+    structures = ''.join(f"""
+  <syntactic_structure type="collocation" id="{i}">
+    <components order="fixed">
+      <component cid="1" type="core" name="head"/>
+      <component cid="2" type="core" name="dependent"/>
+    </components>
+    <dependencies>
+      <dependency from="1" to="2" label="{label}"/>
+      <dependency from="#" to="1" label="#"/>
+    </dependencies>
+    <definition>
+      <component cid="1">{restrictions}<representation><feature rendition="lemma"/></representation></component>
+      <component cid="2"><representation><feature rendition="lemma"/></representation></component>
+    </definition>
+  </syntactic_structure>""" for i, restrictions in enumerate(root_restrictions, start=1))
+    path.write_text(f'<syntactic_structures system_type="{system_type}">{structures}\n</syntactic_structures>',
+                    encoding="utf-8")
+    return str(path)
+
+
+def test_structure_index_ud(tmp_path):
+    """ Test for choosing structures, whose UD root restrictions might match a word. """
+    structures = write_structures(tmp_path / "structures.xml", 'UD', [
+        '<restriction type="morphology"><feature POS="VERB"/></restriction>',
+        '<restriction type="morphology"><feature POS="NOUN" filter="negative"/></restriction>',
+        '',
+        '<restriction type="lexis"><feature lemma="biti"/></restriction>',
+    ])
+    structure_index = cordex.Pipeline(structures).structure_index
+
+    def candidates(word):
+        return [s.id for s in structure_index.candidates(word)]
+
+    assert candidates(WordUD('delati', 'VERB', 's', '1', 1, 'dela', False)) == ['1', '2', '3']
+    # negated part of speech may match any other part of speech
+    assert candidates(WordUD('miza', 'NOUN', 's', '1', 1, 'miza', False)) == ['2', '3']
+    assert candidates(WordUD('biti', 'AUX', 's', '1', 1, 'je', False)) == ['2', '3', '4']
+    # fake root word has no part of speech, so only structures with unrestricted roots may match it
+    assert candidates(WordUD.fake_root_word('s.1')) == ['2', '3']
+
+
+def test_structure_index_jos(tmp_path):
+    """ Test for choosing structures, whose JOS root restrictions might match a word. """
+    structures = write_structures(tmp_path / "structures.xml", 'JOS', [
+        '<restriction type="morphology"><feature POS="noun"/></restriction>',
+        '<restriction_or><restriction type="morphology"><feature POS="verb"/></restriction>'
+        '<restriction type="lexis"><feature lemma="ne"/></restriction></restriction_or>',
+        '<restriction type="morphology"><feature POS="adjective"/></restriction>',
+    ])
+    structure_index = cordex.Pipeline(structures, lookup_lexicon=None).structure_index
+
+    def candidates(word):
+        return [s.id for s in structure_index.candidates(word)]
+
+    assert candidates(WordJOS('miza', 'Ncfsn', 's', '1', 1, 'miza', False, False)) == ['1']
+    assert candidates(WordJOS('delati', 'Vmpr3s', 's', '1', 1, 'dela', False, False)) == ['2']
+    assert candidates(WordJOS('ne', 'Q', 's', '1', 1, 'ne', False, False)) == ['2']
+    assert candidates(WordJOS.fake_root_word('s.1')) == []
+    # words with unknown msds are tested against all structures
+    assert candidates(WordJOS('x', '?', 's', '1', 1, 'x', False, False)) == ['1', '2', '3']
+
+
+@pytest.mark.parametrize("structures,corpus,kwargs", [
+    ("structures_UD.xml", "ssj500k.small.conllu", {}),
+    ("structures_JOS.xml", "test_conllu_jos_small.conllu", {'jos_depparse_lang': 'en', 'lookup_lexicon': None}),
+])
+def test_structure_index_candidates(structures, corpus, kwargs):
+    """ Test that every structure, whose root restrictions match a word of corpus, is among its candidates. """
+    extractor = cordex.Pipeline(os.path.join(STRUCTURES_DIR, structures), **kwargs)
+    structure_index = extractor.structure_index
+    for words in load_file(os.path.join(INPUT_DIR, corpus), extractor.args):
+        for word in words:
+            candidates = structure_index.candidates(word)
+            for s in structure_index.structures:
+                if s.components[0].restrictions.match(word):
+                    assert s in candidates